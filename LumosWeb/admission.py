@@ -0,0 +1,77 @@
+import threading
+import time
+
+from .exceptions import ServiceUnavailable
+
+
+# Caps the number of requests handled at once. Up to max_queue more requests wait for a free slot, but
+# at most queue_timeout seconds; everything beyond that is rejected straight away with a 503.
+class ConcurrencyLimit:
+    def __init__(self, max_concurrency, max_queue=0, queue_timeout=1.0, retry_after=1):
+        assert max_concurrency > 0, "max_concurrency must be at least 1"
+
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+
+        self.in_flight = 0
+        self.queued = 0
+        self.queued_total = 0
+        self.shed_total = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.in_flight < self.max_concurrency:
+                self.in_flight += 1
+                return
+
+            if self.queued >= self.max_queue:
+                self._shed()
+
+            self.queued += 1
+            self.queued_total += 1
+            deadline = time.monotonic() + self.queue_timeout
+            try:
+                while self.in_flight >= self.max_concurrency:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed()
+                    self._condition.wait(remaining)
+                self.in_flight += 1
+            finally:
+                self.queued -= 1
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def _shed(self):
+        self.shed_total += 1
+        raise ServiceUnavailable(retry_after=self.retry_after)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+ADMISSION_METRICS = (
+    ("in_flight", "gauge", "Requests being handled right now."),
+    ("queued", "gauge", "Requests waiting for a free slot right now."),
+    ("queued_total", "counter", "Requests that had to wait for a free slot."),
+    ("shed_total", "counter", "Requests rejected with a 503 because of overload."),
+)
+
+
+# Metrics samples for (scope, ConcurrencyLimit) pairs, see Metrics.add_collector
+def collect(limits):
+    return [
+        (f"lumos_admission_{name}", kind, description, (("scope", scope),), getattr(limit, name))
+        for name, kind, description in ADMISSION_METRICS
+        for scope, limit in limits
+    ]
@@ -1,33 +1,100 @@
+import contextvars
 import select
-import socket
-from webob import Request
+import signal
+import sys
+import threading
 from parse import parse
 import inspect
-from requests import Session as RequestsSession
-from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
-from wsgiref.simple_server import make_server
 import os
-from jinja2 import Environment, FileSystemLoader
-from whitenoise import WhiteNoise
+import time
+from contextlib import ExitStack, contextmanager
 from .middleware import Middleware
+from .request import Request
 from .response import Response
-import markdown
+from .metrics import Metrics, UNMATCHED_ROUTE
+from .tracing import trace_queries
+from .cache import ResponseCache, CachedResponse, CACHEABLE_METHODS
+from .exceptions import HTTPError, PayloadTooLarge
+from . import admission
+from .background import BackgroundPool, logger
+from . import prerender
+from . import sse
+
+# requests, wsgiadapter, jinja2, whitenoise, markdown and cProfile are imported the first time they are
+# needed, so worker spawns and CLI calls don't pay for test tooling and template engines they never use.
 
 class API:
-    def __init__(self, templates_dir="templates", static_dir="static"):
+    def __init__(self, templates_dir="templates", static_dir="static", metrics_dir=None, build_dir=None, webob_responses=False):
         self.routes = {}  # dictionary of routes and handlers, path as keys and handlers as values
 
-        self.templates_env = Environment(
-            loader = FileSystemLoader(os.path.abspath(templates_dir))
-        )
+        self.templates_dir = os.path.abspath(templates_dir)
+        self._templates_env = None
 
         self.exception_handler = None
 
-        self.whitenoise = WhiteNoise(self.wsgi_app, root=static_dir)
+        self.static_dir = static_dir
+        self._whitenoise = None
+
+        # output of `Lumosweb build`, its pages are served as static files instead of calling the handlers
+        self.build_dir = build_dir
+        self._prerendered = None
+        self._build_whitenoise = None
 
         self.middleware = Middleware(self)    
 
         self._server = None
+        self.webob_responses = webob_responses  # send responses through webob.Response, slower but fully compatible
+        self.state = "stopped"  # "running" while serving, "draining" while finishing in-flight requests
+        self._serving = False
+        self._restart = False
+
+        # metrics_dir is shared by pre-fork workers so /metrics can aggregate all of them
+        self.metrics = Metrics(multiprocess_dir=metrics_dir or os.environ.get("LUMOS_METRICS_DIR"))
+
+        self.profiler = None
+
+        # replace with ResponseCache(backend=SQLiteBackend(path)) to share cached responses between workers
+        self.response_cache = ResponseCache()
+        self.metrics.add_collector(lambda: self.response_cache.collect())
+
+        self.concurrency_limit = None
+        self.metrics.add_collector(self._collect_admission)
+
+        # pub/sub hub feeding the server-sent events routes, app.events.publish(channel, data) sends to them
+        self.events = sse.EventHub()
+
+        # runs response.background() tasks, replace with BackgroundPool(max_workers, max_pending) to resize
+        self.background_pool = BackgroundPool()
+
+    @property
+    def templates_env(self):
+        if self._templates_env is None:
+            from jinja2 import Environment, FileSystemLoader
+
+            self._templates_env = Environment(loader=FileSystemLoader(self.templates_dir))
+        return self._templates_env
+
+    @property
+    def whitenoise(self):
+        if self._whitenoise is None:
+            from whitenoise import WhiteNoise
+
+            self._whitenoise = WhiteNoise(self.wsgi_app, root=self.static_dir)
+        return self._whitenoise
+
+    @property
+    def prerendered(self):
+        if self._prerendered is None:
+            self._prerendered = prerender.load_manifest(self.build_dir) if self.build_dir is not None else {}
+        return self._prerendered
+
+    @property
+    def build_whitenoise(self):
+        if self._build_whitenoise is None:
+            from whitenoise import WhiteNoise
+
+            self._build_whitenoise = WhiteNoise(self.middleware, root=self.build_dir)
+        return self._build_whitenoise
 
     def __call__(self, environ, start_response):
         path_info = environ["PATH_INFO"]
@@ -35,8 +102,14 @@ class API:
         if path_info.startswith("/static"):
             environ["PATH_INFO"] = path_info[len("/static"):]
             return self.whitenoise(environ, start_response)
-        
-        return self.middleware(environ, start_response)
+
+        if self.build_dir is not None and path_info in self.prerendered and environ["REQUEST_METHOD"] in ("GET", "HEAD"):
+            environ["PATH_INFO"] = "/" + self.prerendered[path_info]
+            return self.build_whitenoise(environ, start_response)
+
+        # Each request runs in a context of its own, so context variables set while handling it (like the
+        # read-your-writes stickiness of DatabaseRouter) don't leak into the next request served by the thread
+        return contextvars.copy_context().run(self.middleware, environ, start_response)
     
     def wsgi_app(self, environ, start_response):
         request = Request(environ)
@@ -45,17 +118,47 @@ class API:
 
         return response(environ, start_response)
     
-    def add_route(self, path, handler, allowed_methods=None):
+    # cache is the number of seconds GET responses of the route are cached for, vary lists the request
+    # headers that are part of the cache key besides the method, path and query string.
+    # Requests with a body bigger than max_body_size bytes are rejected with 413 before it is read.
+    # static routes don't depend on the request and are rendered to HTML files by `Lumosweb build`.
+    def add_route(self, path, handler, allowed_methods=None, cache=None, vary=(), max_body_size=None, static=False):
         assert path not in self.routes, "You have already used this route, please choose another route :)"
       
-        self.routes[path] = {"handler":handler, "allowed_methods": allowed_methods}  # path as an argument.
+        self.routes[path] = {"handler":handler, "allowed_methods": allowed_methods, "path": path, "cache": cache, "vary": tuple(vary), "limit": None, "max_body_size": max_body_size, "static": static}  # path as an argument.
             
-    def route(self, path, allowed_methods=None):
+    def route(self, path, allowed_methods=None, cache=None, vary=(), max_body_size=None, static=False):
         def wrapper(handler):
-            self.add_route(path, handler, allowed_methods) 
+            self.add_route(path, handler, allowed_methods, cache, vary, max_body_size, static) 
             return handler
         return wrapper
         
+    # Server-sent events route. The handler gets the request and the route parameters and returns
+    # either the name of an app.events channel to subscribe the client to, or an iterable of events.
+    def sse(self, path, heartbeat=15.0, max_buffer=None):
+        def wrapper(handler):
+            # the handler returns a channel of app.events, a subscription to another hub or an iterable of events
+            def sse_handler(req, resp, **kwargs):
+                source = handler(req, **kwargs)
+                if isinstance(source, str):
+                    resp.stream = sse.EventStream(self.events.subscribe(source, max_buffer), heartbeat)
+                elif isinstance(source, sse.Subscription):
+                    resp.stream = sse.EventStream(source, heartbeat)
+                elif hasattr(source, "__iter__") and not isinstance(source, (bytes, dict, sse.EventHub)):
+                    resp.stream = sse.encode(source)
+                else:  # before any header is sent
+                    raise TypeError(
+                        f"sse handler {handler.__name__} returned {type(source).__name__}, expected a channel name, "
+                        "hub.subscribe(channel) or an iterable of events"
+                    )
+                resp.content_type = "text/event-stream"
+                resp.headers["Cache-Control"] = "no-cache"
+                resp.headers["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+
+            self.add_route(path, sse_handler, allowed_methods=["get"])
+            return handler
+        return wrapper
+
     def default_response(self, response):
         response.status_code = 404
         response.text = "Not found. :("
@@ -69,9 +172,19 @@ class API:
         return None, None
     
     def handle_request(self, request):
+        # every ORM query made while handling the request is recorded on this trace
+        with trace_queries() as queries:
+            return self._dispatch(request, queries)
+
+    def _dispatch(self, request, queries):
         response = Response()
+        if self.webob_responses:
+            response.use_webob = True
 
+        started = time.perf_counter()
         handler_data, kwargs = self.find_handler(request_path=request.path)
+        routed = time.perf_counter()
+        route = handler_data["path"] if handler_data is not None else UNMATCHED_ROUTE
         try:
             if handler_data is not None:
                 handler = handler_data["handler"]
@@ -83,19 +196,119 @@ class API:
                 else:
                     if request.method.lower() not in allowed_methods:
                         raise AttributeError("Method not allowed", request.method)
-                handler(request, response, **kwargs)  # **kwargs is used to unpack the dictionary
+                max_body_size = handler_data["max_body_size"]
+                if max_body_size is not None:
+                    if (request.content_length or 0) > max_body_size:
+                        raise PayloadTooLarge(max_body_size)
+                    request.environ["lumos.max_body_size"] = max_body_size  # checked again while streaming
+                with self._admission(handler_data):
+                    if (
+                        handler_data["cache"]
+                        and request.method in CACHEABLE_METHODS
+                        and self.response_cache.is_cacheable(request, handler_data["vary"])
+                    ):
+                        self._call_cached_handler(handler_data, handler, request, response, kwargs)
+                    else:
+                        self._call_handler(route, handler, request, response, kwargs)
             else:
                 self.default_response(response)
         except Exception as e:
-            if self.exception_handler is None:
-                raise e
-            else:
+            self.metrics.observe_exception(route, e)
+            if isinstance(e, HTTPError):
+                e.apply(response)
+            if self.exception_handler is not None:
                 self.exception_handler(request, response, e)
+            elif isinstance(e, HTTPError):
+                response.text = str(e)
+            else:
+                self._observe(request, response, route, queries, started, routed, status=500)
+                raise e
 
+        self._observe(request, response, route, queries, started, routed)
+        if response.background_tasks:
+            response.on_close = lambda: self._run_background_tasks(request, response)
         return response
+
+    def _run_background_tasks(self, request, response):
+        def on_error(exception):
+            if self.exception_handler is None:
+                logger.error("Background task failed", exc_info=exception)
+            else:
+                self.exception_handler(request, response, exception)
+
+        for fn, args, kwargs in response.background_tasks:
+            self.background_pool.submit(fn, args, kwargs, on_error)
+
+    @contextmanager
+    def _admission(self, handler_data):
+        with ExitStack() as stack:
+            # the route's limit first, so requests queued for a slow route don't hold global slots
+            if handler_data["limit"] is not None:
+                stack.enter_context(handler_data["limit"])
+            if self.concurrency_limit is not None:
+                stack.enter_context(self.concurrency_limit)
+            yield
+
+    # Limits how many requests are handled at once, for the whole app or for a single route.
+    # Requests over the limit wait in a bounded queue and get a 503 with Retry-After when it's full.
+    def limit_concurrency(self, max_concurrency, max_queue=0, queue_timeout=1.0, retry_after=1, route=None):
+        limit = admission.ConcurrencyLimit(max_concurrency, max_queue, queue_timeout, retry_after)
+        if route is None:
+            self.concurrency_limit = limit
+        else:
+            assert route in self.routes, f"There is no route {route!r} to limit"
+            self.routes[route]["limit"] = limit
+
+    def _collect_admission(self):
+        limits = [("global", self.concurrency_limit)] if self.concurrency_limit is not None else []
+        limits += [(path, data["limit"]) for path, data in self.routes.items() if data["limit"] is not None]
+        return admission.collect(limits) if limits else []
+
+    def _call_handler(self, route, handler, request, response, kwargs):
+        if self.profiler is not None and self.profiler.should_profile(request, route):
+            self.profiler.run(route, handler, request, response, **kwargs)
+        else:
+            handler(request, response, **kwargs)  # **kwargs is used to unpack the dictionary
+
+    def _call_cached_handler(self, handler_data, handler, request, response, kwargs):
+        def compute():
+            self._call_handler(handler_data["path"], handler, request, response, kwargs)
+            return CachedResponse.from_response(response)
+
+        key = self.response_cache.key(request, handler_data["vary"])
+        entry = self.response_cache.fetch(key, handler_data["cache"], compute)
+        if entry is not None:
+            entry.apply(response)
+        if handler_data["vary"]:
+            response.headers["Vary"] = ", ".join(handler_data["vary"])
+
+    def _observe(self, request, response, route, queries, started, routed, status=None):
+        finished = time.perf_counter()
+        response.timings.append(("routing", routed - started))
+        response.timings.append(("handler", finished - routed))
+        self.metrics.observe(request.method, route, status or response.status_code, finished - started)
+        if queries.count:
+            response.timings.append(("db", queries.duration))
+            self.metrics.observe_queries(route, queries.count, queries.duration)
+
+    def add_metrics_route(self, path="/metrics"):
+        def metrics_handler(req, resp):
+            resp.body = self.metrics.render().encode()
+            resp.content_type = "text/plain; version=0.0.4"
+
+        self.add_route(path, metrics_handler, allowed_methods=["get"])
     
-    # To create a test client for the API
+    # To create a test client for the API, it calls the app directly without going through HTTP libraries
+    def test_client(self, base_url="http://testserver"):
+        from .testing import TestClient
+
+        return TestClient(self, base_url)
+
+    # A requests.Session talking to the API, slower than test_client but it's the real requests API
     def test_session(self, base_url="http://testserver"):
+        from requests import Session as RequestsSession
+        from wsgiadapter import WSGIAdapter as RequestsWSGIAdapter
+
         session = RequestsSession()
         session.mount(prefix=base_url, adapter=RequestsWSGIAdapter(self))
         return session
@@ -109,6 +322,8 @@ class API:
 
         # Check if the file ends with .md extension
         if template_name.endswith('.md'):
+            import markdown  # pulls in Pygments through codehilite, so only .md templates pay for it
+
             # Convert the rendered template to HTML using Markdown
             converted_html = markdown.markdown(rendered_template, extensions=['fenced_code', 'codehilite', 'tables'])
             css_path = os.path.join(os.path.dirname(__file__), 'static/styles.css')
@@ -118,38 +333,110 @@ class API:
         
         return rendered_template
     
+    # Serves a template that needs no request data, e.g. app.add_static_template("/docs", "index.md")
+    def add_static_template(self, path, template_name, context=None):
+        def handler(req, resp):
+            resp.html = self.template(template_name, context)
+
+        self.add_route(path, handler, allowed_methods=["get"], static=True)
+
+    def build(self, output_dir="build"):
+        pages = prerender.build(self, output_dir)
+        self._prerendered = self._build_whitenoise = None  # serve the new pages from now on
+        return pages
+
     def add_exception_handler(self, exception_handler):
         self.exception_handler = exception_handler
 
+    # Profiles single requests with cProfile, see LumosWeb.profiling.Profiler for the options
+    def enable_profiling(self, output_dir, **options):
+        from .profiling import Profiler
+
+        self.profiler = Profiler(output_dir, **options)
+
     def add_middleware(self, middleware_cls):
         self.middleware.add(middleware_cls)
         
     def is_running(self):
-        return self._server is not None and not self._server._BaseServer__is_shut_down.is_set()
-    
-    def run(self, host="localhost", port=8080, timeout=None):
-        attempts = 0
-        while True:
-            try:
-                # Check if the port is available
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.bind((host, port))
-                sock.close()
-                break  # Exit the loop if the port is available
-            except OSError:
-                print(f"Port {port} is not available, trying the next port")
-                attempts += 1
-                port += 1
-                if attempts > 10:
-                    raise Exception("No ports available to run the API")
-                
+        return self.state == "running"
+
+    @property
+    def server_address(self):
+        return None if self._server is None else self._server.server_address[:2]
+
+    # Stops accepting connections, waits up to timeout seconds for in-flight requests and background
+    # tasks, then closes the listening socket. Returns False if something was still running at the deadline.
+    def shutdown(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        drained = True
+        server = self._server
+        if server is not None and self.state == "running":
+            self.state = "draining"
+            if self._serving:
+                server.shutdown()  # makes serve_forever() return in the thread running it
+            self.events.close()  # SSE streams never finish on their own
+            drained = server.drain(timeout)
+            server.server_close()
+            self.state = "stopped"
+
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        return self.background_pool.shutdown(remaining) and drained
+
+    # SIGTERM drains in-flight requests and stops the server, SIGHUP does the same but then re-executes
+    # the process, handing the listening socket down so connections arriving meanwhile wait in its backlog.
+    def _install_signal_handlers(self):
+        if threading.current_thread() is not threading.main_thread():
+            return {}
+
+        def stop(signum, frame):
+            self._restart = signum == getattr(signal, "SIGHUP", None)
+            # server.shutdown() blocks until serve_forever() returns, which runs in this very thread
+            threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+        previous = {}
+        for signum in (signal.SIGTERM, getattr(signal, "SIGHUP", None)):
+            if signum is not None:
+                previous[signum] = signal.signal(signum, stop)
+        return previous
+
+    def _reexec(self, drain_timeout):
+        deadline = None if drain_timeout is None else time.monotonic() + drain_timeout
+        self.state = "draining"
+        self.events.close()
+        self._server.drain(drain_timeout)
+        self.background_pool.shutdown(None if deadline is None else max(deadline - time.monotonic(), 0))
+
+        from .server import LISTEN_FD_ENV
+
+        sock = self._server.socket
+        sock.set_inheritable(True)
+        os.environ[LISTEN_FD_ENV] = str(sock.fileno())
+        sys.stdout.flush()
+        argv = getattr(sys, "orig_argv", [sys.executable] + sys.argv)
+        os.execv(sys.executable, argv)
+
+    def run(self, host="localhost", port=8080, timeout=None, drain_timeout=30):
+        from .server import make_server  # wsgiref and http.server are only needed when serving by ourselves
+
         server = make_server(host, port, self)
         self._server = server
-        actual_port = server.server_port
+        self.state = "running"
+        host, actual_port = self.server_address
         print(f"Starting Lumos server on {host}:{actual_port}")
 
         if timeout is None:
-            server.serve_forever()
+            previous_handlers = self._install_signal_handlers()
+            self._serving = True
+            try:
+                server.serve_forever()
+            finally:
+                self._serving = False
+                for signum, handler in previous_handlers.items():
+                    signal.signal(signum, handler)
+
+            if self._restart:
+                self._reexec(drain_timeout)
+            self.shutdown(drain_timeout)
         else:
             while True:
                 r, _, _ = select.select([server], [], [], timeout)
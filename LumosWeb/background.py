@@ -0,0 +1,72 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("LumosWeb")
+
+
+# Runs the callables scheduled with response.background() once the response has been sent.
+# At most max_workers run at once and max_pending more may wait; when both are used up, submit()
+# blocks the server thread that just finished a response until a slot frees up.
+class BackgroundPool:
+    def __init__(self, max_workers=4, max_pending=100):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = None  # started on the first task, most apps never schedule any
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._pending = 0
+        self._idle = threading.Condition()
+        self._closed = False
+
+    # Returns False when the pool has been shut down: the task is dropped, the response was already sent
+    def submit(self, fn, args=(), kwargs=None, on_error=None):
+        if self._closed:
+            logger.warning("Background pool is shut down, dropping task %r", fn)
+            return False
+
+        self._slots.acquire()
+        with self._idle:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix="lumos-background")
+            self._pending += 1
+        self._executor.submit(self._run, fn, args, kwargs or {}, on_error)
+        return True
+
+    def _run(self, fn, args, kwargs, on_error):
+        try:
+            fn(*args, **kwargs)
+        except Exception as e:
+            if on_error is None:
+                logger.exception("Background task %r failed", fn)
+            else:
+                try:
+                    on_error(e)
+                except Exception:  # would end up on an executor future nobody looks at
+                    logger.exception("Error handler of background task %r failed", fn)
+        finally:
+            self._slots.release()
+            with self._idle:
+                self._pending -= 1
+                if self._pending == 0:
+                    self._idle.notify_all()
+
+    @property
+    def pending(self):
+        return self._pending
+
+    # Stops taking new tasks and waits up to timeout seconds for the scheduled ones to finish.
+    # Returns False if some were still running when the time was up.
+    def shutdown(self, timeout=None):
+        self._closed = True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        return True
@@ -0,0 +1,162 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+CACHEABLE_METHODS = ("GET", "HEAD")
+# Requests carrying these are personalised, their responses are only cached when the route varies on them
+PRIVATE_HEADERS = ("Cookie", "Authorization")
+
+
+class CachedResponse(namedtuple("CachedResponse", ["status_code", "content_type", "headers", "body"])):
+    @classmethod
+    def from_response(cls, response):
+        if response.status_code != 200:
+            return None  # errors and redirects are never cached
+        if response.cookies:
+            return None
+        for name, value in response.headers.items():
+            if name.lower() == "cache-control" and ("private" in value.lower() or "no-store" in value.lower()):
+                return None
+
+        response.set_body_and_content_type()
+        body = response.body.encode() if isinstance(response.body, str) else response.body
+        return cls(response.status_code, response.content_type, dict(response.headers), body)
+
+    def apply(self, response):
+        response.status_code = self.status_code
+        response.content_type = self.content_type
+        response.headers.update(self.headers)
+        response.body = self.body
+
+
+# In-process storage, every worker has its own copy.
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, CachedResponse), least recently used first
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires, entry = item
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# A SQLite file shared by the pre-fork workers of one machine, so a hit in one worker is a hit in all of them.
+class SQLiteBackend:
+    def __init__(self, path, max_entries=10000, touch_interval=60.0):
+        self.max_entries = max_entries
+        # a hit only rewrites the access time once it is this many seconds old, so hits in all workers
+        # don't queue up on SQLite's single writer lock. Eviction is LRU at that granularity.
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=5, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS lumos_cache (key TEXT PRIMARY KEY, expires REAL, accessed REAL,"
+            " status_code INTEGER, content_type TEXT, headers TEXT, body BLOB);"
+        )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT status_code, content_type, headers, body, accessed FROM lumos_cache WHERE key = ? AND expires > ?;",
+                (key, now),
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[4] >= self.touch_interval:
+                self.conn.execute("UPDATE lumos_cache SET accessed = ? WHERE key = ?;", (now, key))
+
+        status_code, content_type, headers, body, _ = row
+        return CachedResponse(status_code, content_type, json.loads(headers), bytes(body))
+
+    def set(self, key, entry, ttl):
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO lumos_cache VALUES (?, ?, ?, ?, ?, ?, ?);",
+                (key, now + ttl, now, entry.status_code, entry.content_type, json.dumps(entry.headers), entry.body),
+            )
+            self.conn.execute(
+                "DELETE FROM lumos_cache WHERE key IN (SELECT key FROM lumos_cache ORDER BY expires < ? ASC,"
+                " accessed DESC LIMIT -1 OFFSET ?);",
+                (now, self.max_entries),
+            )
+
+
+class ResponseCache:
+    def __init__(self, backend=None, max_entries=1024, wait_timeout=10.0):
+        self.backend = backend if backend is not None else MemoryBackend(max_entries)
+        self.wait_timeout = wait_timeout  # how long concurrent misses wait for the first one to finish
+        self.hits = 0
+        self.misses = 0
+        self._pending = {}  # key -> Event of the request currently computing it
+        self._lock = threading.Lock()
+
+    def is_cacheable(self, request, vary=()):
+        vary = {header.lower() for header in vary}
+        return not any(header in request.headers and header.lower() not in vary for header in PRIVATE_HEADERS)
+
+    def key(self, request, vary=()):
+        parts = [request.method, request.path, request.query_string]
+        parts.extend(f"{header}={request.headers.get(header, '')}" for header in vary)
+        return "\n".join(parts)
+
+    # Returns the cached response for key, calling compute() on a miss. Concurrent misses for the
+    # same key are collapsed: only the first one calls compute(), the others wait for its result.
+    def fetch(self, key, ttl, compute):
+        entry = self.backend.get(key)
+        if entry is not None:
+            self.hits += 1
+            return entry
+
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = threading.Event()
+
+        if not leader:
+            pending.wait(self.wait_timeout)
+            entry = self.backend.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            self.misses += 1
+            return compute()  # the first request failed or its response wasn't cacheable
+
+        self.misses += 1
+        try:
+            entry = compute()
+            if entry is not None:
+                self.backend.set(key, entry, ttl)
+            return entry
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.set()
+
+    # Metrics samples, see Metrics.add_collector
+    def collect(self):
+        return [
+            ("lumos_cache_hits_total", "counter", "Responses served from the response cache.", (), self.hits),
+            ("lumos_cache_misses_total", "counter", "Cacheable responses that had to be computed.", (), self.misses),
+        ]
@@ -4,10 +4,13 @@ from LumosWeb.api import API  # Import the API class
 
 
 def main():
-    if len(sys.argv) < 4 or sys.argv[1] != "--app":
+    if len(sys.argv) < 4 or sys.argv[1] != "--app" or sys.argv[3] not in ("run", "build"):
         print("Usage: Lumosweb --app <module_name> run")
+        print("       Lumosweb --app <module_name> build [output_dir]")
         return
 
+    command = sys.argv[3]
+
     app_module = sys.argv[2]
     app_path = os.path.abspath(os.path.join(os.getcwd(), app_module + ".py"))
     app_directory = os.path.dirname(app_path)
@@ -24,7 +27,11 @@ def main():
                 if isinstance(obj, API):
                     app = obj
                     break
-            if app is not None:
+            if app is not None and command == "build":
+                output_dir = sys.argv[4] if len(sys.argv) > 4 else "build"
+                pages = app.build(output_dir)
+                print(f"Prerendered {len(pages)} pages to {output_dir}")
+            elif app is not None:
                 app.run()
             else:
                 raise AttributeError(f"No instance of 'API' found in module: {app_module}")
@@ -0,0 +1,32 @@
+# Exceptions that map to an HTTP error response. The status code and headers are set on the response
+# before the exception handler runs, so a custom handler only needs to render the body. Without one,
+# the message is sent as plain text.
+class HTTPError(Exception):
+    status_code = 500
+    message = "Internal server error."
+
+    def __init__(self, message=None, headers=None):
+        super().__init__(message or self.message)
+        self.headers = headers or {}
+
+    def apply(self, response):
+        response.status_code = self.status_code
+        response.headers.update(self.headers)
+        response.text = response.json = response.html = None  # whatever the handler rendered before failing
+
+
+class ServiceUnavailable(HTTPError):
+    status_code = 503
+    message = "Service unavailable, please retry later."
+
+    def __init__(self, message=None, retry_after=1):
+        super().__init__(message, headers={"Retry-After": str(retry_after)})
+
+
+class PayloadTooLarge(HTTPError):
+    status_code = 413
+    message = "Request body is too large."
+
+    def __init__(self, max_body_size=None):
+        message = None if max_body_size is None else f"Request body is larger than {max_body_size} bytes."
+        super().__init__(message)
@@ -0,0 +1,193 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Upper bounds (in seconds) of the latency histogram buckets, Prometheus style.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Label used for requests that didn't match any route, so random paths can't blow up the series count.
+UNMATCHED_ROUTE = "<unmatched>"
+
+
+class Metrics:
+    def __init__(self, buckets=DEFAULT_BUCKETS, multiprocess_dir=None, flush_interval=1.0):
+        self.buckets = tuple(buckets)
+        self.multiprocess_dir = multiprocess_dir
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._requests = {}    # (method, route, status) -> count
+        self._latency = {}     # route -> [bucket counts..., +Inf count, sum]
+        self._exceptions = {}  # (route, exception name) -> count
+        self._queries = {}     # route -> [query count, seconds spent in queries]
+        self._collectors = []  # callables returning extra samples
+        self._last_flush = 0.0
+
+    def observe(self, method, route, status, duration):
+        bucket = bisect.bisect_left(self.buckets, duration)
+        with self._lock:
+            key = (method, route, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+
+            latency = self._latency.get(route)
+            if latency is None:
+                latency = self._latency[route] = [0] * (len(self.buckets) + 1) + [0.0]
+            latency[bucket] += 1
+            latency[-1] += duration
+
+        if self.multiprocess_dir is not None:
+            self._maybe_flush()
+
+    def observe_exception(self, route, exception):
+        key = (route, type(exception).__name__)
+        with self._lock:
+            self._exceptions[key] = self._exceptions.get(key, 0) + 1
+
+    def observe_queries(self, route, count, duration):
+        with self._lock:
+            queries = self._queries.get(route)
+            if queries is None:
+                queries = self._queries[route] = [0, 0.0]
+            queries[0] += count
+            queries[1] += duration
+
+    # collector() returns (name, type, help, labels, value) samples, labels being (name, value) pairs.
+    # They are part of the worker snapshots, so samples of all workers are summed like the request counters.
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        samples = [
+            [name, kind, description, [list(label) for label in labels], value]
+            for collector in self._collectors
+            for name, kind, description, labels, value in collector()
+        ]
+        with self._lock:
+            return {
+                "requests": [[*key, count] for key, count in self._requests.items()],
+                "latency": {route: list(values) for route, values in self._latency.items()},
+                "exceptions": [[*key, count] for key, count in self._exceptions.items()],
+                "queries": {route: list(values) for route, values in self._queries.items()},
+                "samples": samples,
+            }
+
+    # Pre-fork workers each write their own snapshot file, the /metrics endpoint merges them all.
+    def _maybe_flush(self):
+        now = time.monotonic()
+        if now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        self.flush()
+
+    def flush(self):
+        os.makedirs(self.multiprocess_dir, exist_ok=True)
+        path = os.path.join(self.multiprocess_dir, f"metrics_{os.getpid()}.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.snapshot(), file)
+        os.replace(tmp_path, path)  # atomic, so readers never see half written files
+
+    def _collect_snapshots(self):
+        if self.multiprocess_dir is None:
+            return [self.snapshot()]
+
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.multiprocess_dir):
+            if not (name.startswith("metrics_") and name.endswith(".json")):
+                continue
+            try:
+                with open(os.path.join(self.multiprocess_dir, name)) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue  # the worker is rewriting it right now or it has gone away
+        return snapshots
+
+    def render(self):
+        requests = {}
+        latency = {}
+        exceptions = {}
+        queries = {}
+        samples = {}  # name -> (type, help, {labels: value})
+        for snapshot in self._collect_snapshots():
+            for method, route, status, count in snapshot["requests"]:
+                key = (method, route, status)
+                requests[key] = requests.get(key, 0) + count
+            for route, values in snapshot["latency"].items():
+                merged = latency.setdefault(route, [0] * (len(self.buckets) + 1) + [0.0])
+                for index, value in enumerate(values):
+                    merged[index] += value
+            for route, name, count in snapshot["exceptions"]:
+                exceptions[(route, name)] = exceptions.get((route, name), 0) + count
+            for route, (count, duration) in snapshot.get("queries", {}).items():
+                merged = queries.setdefault(route, [0, 0.0])
+                merged[0] += count
+                merged[1] += duration
+            for name, kind, description, labels, value in snapshot.get("samples", []):
+                values = samples.setdefault(name, (kind, description, {}))[2]
+                labels = tuple(tuple(label) for label in labels)
+                values[labels] = values.get(labels, 0) + value
+
+        lines = [
+            "# HELP lumos_requests_total Total number of handled requests.",
+            "# TYPE lumos_requests_total counter",
+        ]
+        for (method, route, status), count in sorted(requests.items()):
+            lines.append(
+                f'lumos_requests_total{{method="{method}",route="{_escape(route)}",status="{status}"}} {count}'
+            )
+
+        lines += [
+            "# HELP lumos_request_duration_seconds Time spent routing and handling requests.",
+            "# TYPE lumos_request_duration_seconds histogram",
+        ]
+        for route, values in sorted(latency.items()):
+            label = _escape(route)
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f'lumos_request_duration_seconds_bucket{{route="{label}",le="{bound}"}} {cumulative}')
+            cumulative += values[len(self.buckets)]
+            lines.append(f'lumos_request_duration_seconds_bucket{{route="{label}",le="+Inf"}} {cumulative}')
+            lines.append(f'lumos_request_duration_seconds_sum{{route="{label}"}} {values[-1]}')
+            lines.append(f'lumos_request_duration_seconds_count{{route="{label}"}} {cumulative}')
+
+        lines += [
+            "# HELP lumos_request_exceptions_total Exceptions raised by handlers.",
+            "# TYPE lumos_request_exceptions_total counter",
+        ]
+        for (route, name), count in sorted(exceptions.items()):
+            lines.append(f'lumos_request_exceptions_total{{route="{_escape(route)}",exception="{name}"}} {count}')
+
+        lines += [
+            "# HELP lumos_db_queries_total SQL queries executed while handling requests.",
+            "# TYPE lumos_db_queries_total counter",
+        ]
+        for route, (count, _) in sorted(queries.items()):
+            lines.append(f'lumos_db_queries_total{{route="{_escape(route)}"}} {count}')
+
+        lines += [
+            "# HELP lumos_db_query_duration_seconds_total Time spent in SQL queries while handling requests.",
+            "# TYPE lumos_db_query_duration_seconds_total counter",
+        ]
+        for route, (_, duration) in sorted(queries.items()):
+            lines.append(f'lumos_db_query_duration_seconds_total{{route="{_escape(route)}"}} {duration}')
+
+        for name, (kind, description, values) in samples.items():
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for labels, value in sorted(values.items()):
+                label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+                lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Builds the value of the Server-Timing header from (name, seconds) pairs.
+def server_timing(timings):
+    return ", ".join(f"{name};dur={duration * 1000:.3f}" for name, duration in timings)
@@ -1,67 +1,350 @@
+import contextvars
 import inspect
+import itertools
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from typing import Any
+from .tracing import current_trace
 
 class Database:
     def __init__(self, path):
-        self.conn = sqlite3.Connection(path)
+        self.path = path
+        # shared by the threads of a threaded server, the lock keeps them from interleaving statements and commits
+        self.conn = sqlite3.Connection(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.write_coordinator = None
+
+    # Sends save/update/delete through a single writer that commits the writes of many concurrent
+    # requests in one transaction, instead of one commit (and fsync) per write.
+    def enable_group_commit(self, window=0.001, max_batch=64, timeout=30.0):
+        self.write_coordinator = WriteCoordinator(self.path, window, max_batch, timeout)
+
+    def close(self):
+        if self.write_coordinator is not None:
+            self.write_coordinator.stop()
+        self.conn.close()
 
     @property
     def tables(self):
         SELECT_TABLES_SQL = "SELECT name FROM sqlite_master WHERE type='table';"
-        return [x[0] for x in self.conn.execute(SELECT_TABLES_SQL).fetchall()]
+        return [x[0] for x in self._execute(SELECT_TABLES_SQL, fetch="all")]
+
+    # Every statement goes through here so it can be recorded on the current query trace
+    def _execute(self, sql, params=(), fetch=None):
+        started = time.perf_counter()
+        with self._lock:
+            cursor = self.conn.execute(sql, params)
+            if fetch == "all":
+                result = cursor.fetchall()
+                rows = len(result)
+            elif fetch == "one":
+                result = cursor.fetchone()
+                rows = 0 if result is None else 1
+            else:
+                result = cursor
+                rows = cursor.rowcount
+
+        trace = current_trace()
+        if trace is not None:
+            trace.record(sql, params, time.perf_counter() - started, rows)
+        return result
+
+    # Runs a write statement and commits it, returns the id of the inserted row and the number of rows changed
+    def _write(self, sql, params):
+        if self.write_coordinator is None:
+            with self._lock:
+                cursor = self._execute(sql, params)
+                self.conn.commit()
+            return cursor.lastrowid, cursor.rowcount
+
+        started = time.perf_counter()
+        lastrowid, rows = self.write_coordinator.execute(sql, params)
+        trace = current_trace()
+        if trace is not None:
+            trace.record(sql, params, time.perf_counter() - started, rows)
+        return lastrowid, rows
         
     def create(self, table):
-        self.conn.execute(table._get_create_sql())
+        self._execute(table._get_create_sql())
+        search_sql = table._get_create_search_sql()
+        if search_sql:
+            new_index = table._get_search_table() not in self.tables
+            for sql in search_sql:
+                self._execute(sql)
+            if new_index:  # the triggers only index rows written from now on
+                self._write(table._get_rebuild_search_sql(), ())
 
     def save(self, instance):
         sql, values = instance._get_insert_sql()
-        cursor = self.conn.execute(sql, values)
-        instance._data["id"] = cursor.lastrowid
-        self.conn.commit()
+        instance._data["id"], _ = self._write(sql, values)
 
-    def all(self, table):
+    # get_related(table, id) looks up the rows foreign keys point to, this database by default
+    def all(self, table, get_related=None):
         sql, fields = table._get_select_sql()
 
-        result = []
-        for row in self.conn.execute(sql).fetchall():
-            instance = table()
-            for field, value in zip(fields, row):
-                if field.endswith("_id"):
-                    field = field[:-3]
-                    fk = getattr(table, field)
-                    value = self.get(fk.table, value)
-                setattr(instance, field, value)
-            result.append(instance)
-
-        return result
+        return [self._build_instance(table, fields, row, get_related) for row in self._execute(sql, fetch="all")]
     
-    def get(self, table, id):
+    def get(self, table, id, get_related=None):
         sql, fields, params = table._get_select_where_sql(id = id)
 
-        row = self.conn.execute(sql, params).fetchone()
+        row = self._execute(sql, params, fetch="one")
         if row is None:
             raise Exception(f"{table.__name__} instance with id {id} does not exist")
-        
+
+        return self._build_instance(table, fields, row, get_related)
+
+    # Full-text search over the searchable columns of the table, best matches first. Rows must contain
+    # every word of query, which is taken literally, so search box input can't break the statement.
+    # With raw=True query uses the SQLite FTS5 syntax instead, e.g. "potter OR granger", "pott*".
+    def search(self, table, query, limit=20, offset=0, raw=False, get_related=None):
+        if not raw:
+            query = " ".join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+            if not query:
+                return []
+        sql, fields, params = table._get_search_sql(query, limit, offset)
+        return [self._build_instance(table, fields, row, get_related) for row in self._execute(sql, params, fetch="all")]
+
+    def _build_instance(self, table, fields, row, get_related=None):
+        get_related = get_related or self.get
         instance = table()
         for field, value in zip(fields, row):
             if field.endswith("_id"):
                 field = field[:-3]
                 fk = getattr(table, field)
-                value = self.get(fk.table, value)
+                value = get_related(fk.table, value)
             setattr(instance, field, value)
 
         return instance
     
     def update(self, instance):
         sql, values = instance._get_update_sql()
-        self.conn.execute(sql, values)
-        self.conn.commit()
+        _, rows = self._write(sql, values)
+        return rows
 
     def delete(self, table, id):
         sql, params = table._get_delete_sql(id)
-        self.conn.execute(sql, params)
-        self.conn.commit()
+        _, rows = self._write(sql, params)
+        return rows
+
+
+# Routers the current request has written through; their reads go to the primary from then on,
+# so a request always sees its own writes even when the replicas lag behind.
+_sticky_routers = contextvars.ContextVar("lumos_sticky_routers", default=frozenset())
+
+
+# Sends writes to the primary and spreads reads round-robin over the replicas (read-only copies of the
+# primary kept up to date by whatever replicates it, e.g. Litestream or a periodic file copy).
+# API runs every request in its own context, so the stickiness lasts for one request.
+class DatabaseRouter:
+    def __init__(self, primary, replicas=()):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self._next_replica = itertools.count()
+
+    def close(self):
+        for database in [self.primary, *self.replicas]:
+            database.close()
+
+    @property
+    def tables(self):
+        return self.primary.tables
+
+    def for_read(self):
+        if not self.replicas or self in _sticky_routers.get():
+            return self.primary
+        return self.replicas[next(self._next_replica) % len(self.replicas)]
+
+    def for_write(self):
+        sticky = _sticky_routers.get()
+        if self not in sticky:
+            _sticky_routers.set(sticky | {self})
+        return self.primary
+
+    # Replicas get the schema too, so reads work before the first replication run
+    def create(self, table):
+        for database in [self.primary, *self.replicas]:
+            database.create(table)
+
+    def save(self, instance):
+        self.for_write().save(instance)
+
+    def update(self, instance):
+        return self.for_write().update(instance)
+
+    def delete(self, table, id):
+        return self.for_write().delete(table, id)
+
+    def all(self, table, get_related=None):
+        return self.for_read().all(table, get_related)
+
+    def get(self, table, id, get_related=None):
+        return self.for_read().get(table, id, get_related)
+
+    def search(self, table, query, limit=20, offset=0, raw=False, get_related=None):
+        return self.for_read().search(table, query, limit, offset, raw, get_related)
+
+
+# Spreads rows over several databases (Database or DatabaseRouter), e.g. one file per tenant or per table.
+# shard_key(table, instance) returns the name of the shard for a row, with instance=None for reads;
+# a shard can also be passed explicitly. all() without a known shard reads every shard.
+# Foreign keys are looked up in the shard of the related table, or in the row's own shard when
+# shard_key can't tell it from the table alone.
+class ShardedDatabase:
+    def __init__(self, shards, shard_key):
+        self.shards = shards  # name -> database
+        self.shard_key = shard_key
+
+    def close(self):
+        for database in self.shards.values():
+            database.close()
+
+    def shard_for(self, table, instance=None, shard=None):
+        if shard is None:
+            shard = self.shard_key(table, instance)
+        if shard is None:
+            raise Exception(f"No shard given for {table.__name__}")
+        return self.shards[shard]
+
+    def create(self, table):
+        shard = self.shard_key(table, None)
+        for database in self.shards.values() if shard is None else [self.shards[shard]]:
+            database.create(table)
+
+    def save(self, instance, shard=None):
+        self.shard_for(type(instance), instance, shard).save(instance)
+
+    def update(self, instance, shard=None):
+        return self.shard_for(type(instance), instance, shard).update(instance)
+
+    def delete(self, table, id, shard=None):
+        return self.shard_for(table, None, shard).delete(table, id)
+
+    def all(self, table, shard=None):
+        if shard is None:
+            shard = self.shard_key(table, None)
+        if shard is None:
+            return [
+                instance
+                for database in self.shards.values()
+                for instance in database.all(table, self._related(database))
+            ]
+        database = self.shards[shard]
+        return database.all(table, self._related(database))
+
+    def get(self, table, id, shard=None):
+        database = self.shard_for(table, None, shard)
+        return database.get(table, id, self._related(database))
+
+    def search(self, table, query, limit=20, offset=0, raw=False, shard=None):
+        database = self.shard_for(table, None, shard)
+        return database.search(table, query, limit, offset, raw, self._related(database))
+
+    # get_related for the rows read from database
+    def _related(self, database):
+        def get_related(table, id):
+            shard = self.shard_key(table, None)
+            if shard is None:
+                return database.get(table, id, get_related)
+            return self.get(table, id, shard)
+        return get_related
+
+
+# A shard_key putting each table in its own shard: shard_by_table({Author: "authors", Book: "books"})
+def shard_by_table(mapping, default=None):
+    def shard_key(table, instance):
+        return mapping.get(table, default)
+    return shard_key
+
+
+class WriteCoordinator:
+    def __init__(self, path, window=0.001, max_batch=64, timeout=30.0):
+        self.window = window  # how long to wait for more writes once the first one of a batch arrived
+        self.max_batch = max_batch
+        self.timeout = timeout  # how long a caller waits for its write to be committed
+        self.commits = 0
+        self.stopped = False
+
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL;")  # readers don't wait for the writer
+        self._queue = queue.Queue()
+        self._stop_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="lumos-group-commit", daemon=True)
+        self._thread.start()
+
+    # Blocks until the transaction holding the write is committed, returns (lastrowid, rowcount)
+    def execute(self, sql, params=()):
+        future = Future()
+        with self._stop_lock:
+            if self.stopped:
+                raise RuntimeError("The write coordinator has been stopped")
+            self._queue.put((sql, params, future))
+        return future.result(self.timeout)  # raises TimeoutError if the writer is stuck
+
+    # Commits the writes queued so far, later ones raise RuntimeError
+    def stop(self):
+        with self._stop_lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self._queue.put(None)
+        self._thread.join()
+        self.conn.close()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+            if stopping:
+                return
+
+    def _commit(self, batch):
+        results = []
+        try:
+            self.conn.execute("BEGIN IMMEDIATE;")
+            for sql, params, future in batch:
+                # a failing write only rolls back itself, not the other requests' writes in the batch
+                self.conn.execute("SAVEPOINT lumos_write;")
+                try:
+                    cursor = self.conn.execute(sql, params)
+                except Exception as e:
+                    self.conn.execute("ROLLBACK TO lumos_write;")
+                    results.append((future, None, e))
+                else:
+                    results.append((future, (cursor.lastrowid, cursor.rowcount), None))
+                self.conn.execute("RELEASE lumos_write;")
+            self.conn.execute("COMMIT;")
+            self.commits += 1
+        except Exception as e:
+            if self.conn.in_transaction:
+                self.conn.execute("ROLLBACK;")
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
 
 class Table:
     def __init__(self, **kwargs):
@@ -89,6 +372,63 @@ class Table:
         name = cls.__name__.lower()
         return CREATE_TABLE_SQL.format(name=name, fields=fields)
     
+    @classmethod
+    def _get_search_columns(cls):
+        return [name for name, field in inspect.getmembers(cls) if isinstance(field, Column) and field.searchable]
+
+    # An FTS5 index over the searchable columns, kept in sync with the table by triggers,
+    # so rows written by save/update/delete or by plain SQL are all indexed.
+    @classmethod
+    def _get_search_table(cls):
+        return f"{cls.__name__.lower()}_fts"
+
+    @classmethod
+    def _get_create_search_sql(cls):
+        columns = cls._get_search_columns()
+        if not columns:
+            return []
+
+        name = cls.__name__.lower()
+        fts = cls._get_search_table()
+        fields = ", ".join(columns)
+        new_values = ", ".join(f"new.{column}" for column in columns)
+        old_values = ", ".join(f"old.{column}" for column in columns)
+        insert_new = f"INSERT INTO {fts} (rowid, {fields}) VALUES (new.id, {new_values});"
+        delete_old = f"INSERT INTO {fts} ({fts}, rowid, {fields}) VALUES ('delete', old.id, {old_values});"
+
+        return [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({fields}, content='{name}', content_rowid='id');",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {name} BEGIN {insert_new} END;",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {name} BEGIN {delete_old} END;",
+            f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {name} BEGIN {delete_old} {insert_new} END;",
+        ]
+
+    # Indexes the rows already in the table
+    @classmethod
+    def _get_rebuild_search_sql(cls):
+        fts = cls._get_search_table()
+        return f"INSERT INTO {fts} ({fts}) VALUES ('rebuild');"
+
+    @classmethod
+    def _get_search_sql(cls, query, limit, offset):
+        SEARCH_SQL = "SELECT {fields} FROM {fts} JOIN {name} ON {name}.id = {fts}.rowid WHERE {fts} MATCH ? ORDER BY {fts}.rank LIMIT ? OFFSET ?;"
+        assert cls._get_search_columns(), f"{cls.__name__} has no searchable columns"
+
+        name = cls.__name__.lower()
+        fields = ["id"]
+        for field_name, field in inspect.getmembers(cls):
+            if isinstance(field, Column):
+                fields.append(field_name)
+            if isinstance(field, ForeignKey):
+                fields.append(field_name + "_id")
+
+        sql = SEARCH_SQL.format(
+            fields=", ".join(f"{name}.{field}" for field in fields), fts=f"{name}_fts", name=name
+        )
+        params = [query, limit, offset]
+
+        return sql, fields, params
+
     def __getattribute__(self, key):
         _data = super().__getattribute__("_data")
         if key in _data:
@@ -186,8 +526,10 @@ class Table:
             
     
 class Column:
-    def __init__(self, column_type):
+    def __init__(self, column_type, searchable=False):
+        assert not searchable or column_type is str, "Only str columns can be searchable"
         self.type = column_type
+        self.searchable = searchable  # indexed for Database.search with SQLite FTS5
 
     @property
     def sql_type(self):
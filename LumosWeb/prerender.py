@@ -0,0 +1,62 @@
+import json
+import os
+import re
+
+MANIFEST_NAME = "lumos-build.json"
+
+STYLESHEET_LINK = re.compile(r"""<link\b[^>]*\bhref=["']/static/([^"']+\.css)["'][^>]*>""", re.IGNORECASE)
+
+
+def page_name(path):
+    return "index.html" if path == "/" else path.strip("/") + ".html"
+
+
+# Replaces <link href="/static/...css"> tags with the stylesheet itself, so a page is a single file
+def inline_stylesheets(html, static_dir):
+    def replace(match):
+        css_path = os.path.join(static_dir, match.group(1))
+        if not os.path.isfile(css_path):
+            return match.group(0)
+        with open(css_path, encoding="utf-8") as css_file:
+            return f"<style>{css_file.read()}</style>"
+
+    return STYLESHEET_LINK.sub(replace, html)
+
+
+# Renders every route marked static=True to an HTML file in output_dir. At runtime an API created with
+# build_dir=output_dir serves those files like static files, without calling the handlers.
+def build(api, output_dir):
+    from .testing import TestClient
+
+    os.makedirs(output_dir, exist_ok=True)
+    client = TestClient(api.middleware)  # past the prerendered pages of a previous build, to the handlers
+    pages = {}
+
+    for path, handler_data in api.routes.items():
+        if not handler_data["static"]:
+            continue
+        assert "{" not in path, f"Route {path!r} has parameters and can't be prerendered"
+
+        response = client.get(path)
+        if response.status_code != 200:
+            raise Exception(f"Prerendering {path!r} failed with status {response.status_code}")
+
+        name = page_name(path)
+        page_path = os.path.join(output_dir, name)
+        os.makedirs(os.path.dirname(page_path), exist_ok=True)
+        with open(page_path, "w", encoding="utf-8") as page:
+            page.write(inline_stylesheets(response.text, api.static_dir))
+        pages[path] = name
+
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as manifest:
+        json.dump(pages, manifest, indent=2)
+
+    return pages
+
+
+def load_manifest(build_dir):
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME)) as manifest:
+            return json.load(manifest)
+    except FileNotFoundError:
+        return {}
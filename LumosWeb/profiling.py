@@ -0,0 +1,117 @@
+import cProfile
+import hmac
+import itertools
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+FORMATS = ("pstats", "collapsed")
+
+# Held by the request being profiled. From Python 3.12 only one cProfile can be enabled at a time,
+# so requests arriving meanwhile run without profiling.
+_profiling = threading.Lock()
+
+
+class Profiler:
+    def __init__(self, output_dir, token=None, header="X-Lumos-Profile", sample_rate=0.0, routes=(), format="pstats"):
+        assert format in FORMATS, f"Unknown profile format {format!r}, choose one of {FORMATS}"
+        assert 0.0 <= sample_rate <= 1.0, "sample_rate is a fraction between 0 and 1"
+
+        self.output_dir = output_dir
+        self.token = token  # without a token the header can't switch profiling on
+        self.header = header
+        self.sample_rate = sample_rate
+        self.routes = set(routes)  # route templates that are always profiled
+        self.format = format
+        self._dumps = itertools.count(1)  # keeps the names of profiles dumped in the same millisecond apart
+
+    def should_profile(self, request, route):
+        if route in self.routes:
+            return True
+
+        if self.token is not None:
+            value = request.headers.get(self.header)
+            # compare_digest only takes ASCII str, header values can be anything
+            if value is not None and hmac.compare_digest(value.encode("utf-8"), self.token.encode("utf-8")):
+                return True
+
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def run(self, route, handler, *args, **kwargs):
+        if not _profiling.acquire(blocking=False):
+            return handler(*args, **kwargs)
+
+        try:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.dump(profile, route)
+        finally:
+            _profiling.release()
+
+    def dump(self, profile, route):
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+        extension = "prof" if self.format == "pstats" else "collapsed"
+        path = os.path.join(self.output_dir, f"{slug}-{int(time.time() * 1000)}-{os.getpid()}-{next(self._dumps)}.{extension}")
+
+        if self.format == "pstats":
+            profile.dump_stats(path)
+        else:
+            with open(path, "w") as file:
+                file.writelines(f"{stack} {weight}\n" for stack, weight in collapse(pstats.Stats(profile)))
+
+        return path
+
+
+def _label(func):
+    filename, line, name = func
+    if filename == "~":  # built-in functions have no source location
+        label = name
+    else:
+        label = f"{name} ({os.path.basename(filename)}:{line})"
+    return label.replace(";", ",")
+
+
+# cProfile only keeps caller/callee pairs, not whole stacks. The stacks for flame graph tools are
+# rebuilt by walking down from the root functions, splitting a function's own time between its
+# callers in proportion to how much of its cumulative time each of them accounts for.
+def collapse(stats):
+    callees = {}
+    for func, (_, _, _, _, callers) in stats.stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(func)
+
+    roots = [
+        func for func, (_, _, _, _, callers) in stats.stats.items()
+        if not any(caller in stats.stats for caller in callers)
+    ]
+
+    stacks = {}
+
+    def walk(func, stack, on_stack, scale):
+        _, _, own_time, total_time, _ = stats.stats[func]
+        stack = stack + [_label(func)]
+        weight = int(own_time * scale * 1_000_000)
+        if weight > 0:
+            key = ";".join(stack)
+            stacks[key] = stacks.get(key, 0) + weight
+
+        for callee in callees.get(func, ()):
+            if callee in on_stack:
+                continue  # recursion, the time is already counted on the outer frame
+            callee_total = stats.stats[callee][3]
+            edge_total = stats.stats[callee][4][func][3]
+            if callee_total > 0 and edge_total > 0:
+                walk(callee, stack, on_stack | {callee}, scale * edge_total / callee_total)
+
+    for root in roots:
+        walk(root, [], {root}, 1.0)
+
+    return sorted(stacks.items())
@@ -0,0 +1,401 @@
+import json
+import tempfile
+from functools import cached_property
+from io import BytesIO
+from urllib.parse import parse_qsl, quote
+
+from .exceptions import PayloadTooLarge
+
+CHUNK_SIZE = 64 * 1024
+SPOOL_THRESHOLD = 1024 * 1024  # uploaded files bigger than this are moved from memory to a temp file
+
+PATH_SAFE = "/~!$&'()*+,;=:@"  # characters webob leaves unquoted in request.path
+FORM_METHODS = ("POST", "PUT", "PATCH", "DELETE")
+
+
+# Values for a key are kept in the order they came in, d[key] returns the last one like webob's MultiDict
+class MultiDict:
+    def __init__(self, items=()):
+        self._items = list(items)
+
+    def __getitem__(self, key):
+        for k, value in reversed(self._items):
+            if k == key:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def getall(self, key):
+        return [value for k, value in self._items if k == key]
+
+    def add(self, key, value):
+        self._items.append((key, value))
+
+    def __contains__(self, key):
+        return any(k == key for k, _ in self._items)
+
+    def __iter__(self):
+        return (key for key, _ in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [value for _, value in self._items]
+
+    def items(self):
+        return list(self._items)
+
+    def mixed(self):
+        result = {}
+        for key, value in self._items:
+            if key in result:
+                if not isinstance(result[key], list):
+                    result[key] = [result[key]]
+                result[key].append(value)
+            else:
+                result[key] = value
+        return result
+
+    def __repr__(self):
+        return f"MultiDict({self._items!r})"
+
+
+# Read-only view of the HTTP headers in a WSGI environ, with case-insensitive names
+class EnvironHeaders:
+    def __init__(self, environ):
+        self.environ = environ
+
+    @staticmethod
+    def _key(name):
+        key = name.upper().replace("-", "_")
+        return key if key in ("CONTENT_TYPE", "CONTENT_LENGTH") else "HTTP_" + key
+
+    def __getitem__(self, name):
+        return self.environ[self._key(name)]
+
+    def get(self, name, default=None):
+        return self.environ.get(self._key(name), default)
+
+    def __contains__(self, name):
+        return self._key(name) in self.environ
+
+    def __iter__(self):
+        for key in self.environ:
+            if key.startswith("HTTP_"):
+                yield key[5:].replace("_", "-").title()
+            elif key in ("CONTENT_TYPE", "CONTENT_LENGTH") and self.environ[key]:
+                yield key.replace("_", "-").title()
+
+    def items(self):
+        return [(name, self[name]) for name in self]
+
+
+# The request handlers get. It only wraps the environ: the query string, headers, cookies and body
+# are parsed the first time they are used, so handlers that only look at the path pay for nothing else.
+# Attributes it doesn't have itself are looked up on a webob.Request built on demand.
+class Request:
+    def __init__(self, environ):
+        self.environ = environ
+
+    @property
+    def method(self):
+        return self.environ["REQUEST_METHOD"]
+
+    @property
+    def script_name(self):
+        return self.environ.get("SCRIPT_NAME", "").encode("latin-1").decode("utf-8")
+
+    @property
+    def path_info(self):
+        return self.environ.get("PATH_INFO", "").encode("latin-1").decode("utf-8")
+
+    @cached_property
+    def path(self):
+        raw = self.environ.get("SCRIPT_NAME", "") + self.environ.get("PATH_INFO", "")
+        return quote(raw.encode("latin-1"), safe=PATH_SAFE)
+
+    @property
+    def query_string(self):
+        return self.environ.get("QUERY_STRING", "")
+
+    @property
+    def scheme(self):
+        return self.environ["wsgi.url_scheme"]
+
+    @property
+    def host(self):
+        environ = self.environ
+        return environ.get("HTTP_HOST") or f"{environ['SERVER_NAME']}:{environ['SERVER_PORT']}"
+
+    @cached_property
+    def host_url(self):
+        host = self.environ.get("HTTP_HOST")
+        if host is not None:
+            port = None
+            if ":" in host and not host.endswith("]"):  # an IPv6 address alone ends with "]"
+                host, port = host.rsplit(":", 1)
+        else:
+            host, port = self.environ["SERVER_NAME"], self.environ.get("SERVER_PORT")
+        if (self.scheme, port) in (("http", "80"), ("https", "443")):
+            port = None
+        return f"{self.scheme}://{host}:{port}" if port else f"{self.scheme}://{host}"
+
+    @property
+    def path_url(self):
+        return self.host_url + self.path
+
+    @property
+    def url(self):
+        query_string = self.query_string
+        return self.path_url + "?" + query_string if query_string else self.path_url
+
+    @property
+    def remote_addr(self):
+        return self.environ.get("REMOTE_ADDR")
+
+    @cached_property
+    def headers(self):
+        return EnvironHeaders(self.environ)
+
+    @property
+    def content_type(self):
+        return self.environ.get("CONTENT_TYPE", "").split(";", 1)[0].strip()
+
+    @property
+    def content_length(self):
+        try:
+            length = int(self.environ.get("CONTENT_LENGTH"))
+        except (TypeError, ValueError):  # missing or malformed
+            return None
+        return length if length >= 0 else None
+
+    @property
+    def charset(self):
+        charset = _header_param("Content-Type", self.environ.get("CONTENT_TYPE", ""), "charset")
+        return charset or "UTF-8"
+
+    @cached_property
+    def GET(self):
+        return MultiDict(parse_qsl(self.query_string, keep_blank_values=True))
+
+    @cached_property
+    def POST(self):
+        if self.method not in FORM_METHODS:
+            return MultiDict()
+        if self.content_type == "application/x-www-form-urlencoded":
+            return MultiDict(parse_qsl(self.text, keep_blank_values=True))
+        if self.content_type == "multipart/form-data":
+            fields, files = self.multipart()
+            return MultiDict(fields.items() + files.items())
+        return MultiDict()
+
+    # GET values win over POST values with the same key, like webob's NestedMultiDict
+    @cached_property
+    def params(self):
+        return MultiDict(self.POST.items() + self.GET.items())
+
+    @cached_property
+    def cookies(self):
+        from http.cookies import CookieError, SimpleCookie
+
+        cookie = SimpleCookie()
+        try:
+            cookie.load(self.environ.get("HTTP_COOKIE", ""))
+        except CookieError:
+            return {}
+        return {name: morsel.value for name, morsel in cookie.items()}
+
+    @cached_property
+    def body(self):
+        body = b"".join(self.stream())
+        # later readers, webob included, get a fresh stream over the same bytes
+        self.environ["wsgi.input"] = BytesIO(body)
+        self.environ["CONTENT_LENGTH"] = str(len(body))
+        return body
+
+    @property
+    def text(self):
+        return self.body.decode(self.charset)
+
+    @property
+    def json(self):
+        return json.loads(self.body)
+
+    json_body = json
+
+    @cached_property
+    def webob(self):
+        from webob import Request as WebObRequest
+
+        return WebObRequest(self.environ)
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self.webob, name)
+
+    def __repr__(self):
+        return f"<Request {self.method} {self.url}>"
+
+    # Reads the body incrementally instead of loading it into memory like req.body and req.POST do.
+    # The route's max_body_size is enforced while reading, even when there is no Content-Length.
+    def stream(self, chunk_size=CHUNK_SIZE):
+        if "body" in self.__dict__:  # already read
+            body = self.body
+            for start in range(0, len(body), chunk_size):
+                yield body[start:start + chunk_size]
+            return
+
+        if self.environ.get("lumos.body_consumed"):
+            raise RuntimeError("The request body has already been read by req.stream(), req.multipart() or req.POST")
+
+        max_body_size = self.environ.get("lumos.max_body_size")
+        length = self.content_length
+        if length is None and not self.environ.get("wsgi.input_terminated"):
+            return  # no Content-Length and the server can't tell us where the body ends
+        if length is not None and max_body_size is not None and length > max_body_size:
+            raise PayloadTooLarge(max_body_size)
+
+        stream = self.environ["wsgi.input"]
+        # the body isn't kept, later readers get an error (or an empty body for webob) instead of waiting on the socket
+        self.environ["lumos.body_consumed"] = True
+        self.environ["wsgi.input"] = BytesIO()
+        self.environ["CONTENT_LENGTH"] = "0"
+        remaining = length
+        received = 0
+        while remaining is None or remaining > 0:
+            chunk = stream.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            received += len(chunk)
+            if max_body_size is not None and received > max_body_size:
+                raise PayloadTooLarge(max_body_size)
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+    # Streaming multipart/form-data parser, returns (fields, files) MultiDicts.
+    # File parts are written to SpooledTemporaryFiles so large uploads never sit in memory.
+    def multipart(self, spool_threshold=SPOOL_THRESHOLD, chunk_size=CHUNK_SIZE):
+        if self.content_type != "multipart/form-data":
+            raise ValueError(f"Expected a multipart/form-data body, got {self.content_type!r}")
+        boundary = _header_param("Content-Type", self.headers.get("Content-Type", ""), "boundary")
+        if not boundary:
+            raise ValueError("The multipart/form-data body has no boundary")
+
+        return parse_multipart(self.stream(chunk_size), boundary.encode("latin-1"), spool_threshold)
+
+
+class UploadedFile:
+    def __init__(self, name, filename, content_type, file):
+        self.name = name
+        self.filename = filename
+        self.content_type = content_type
+        self.file = file
+        self.size = 0
+
+    def read(self, *args):
+        return self.file.read(*args)
+
+    def close(self):
+        self.file.close()
+
+
+def _header_param(header, value, param):
+    from email.message import Message  # slow to import and only needed for bodies with parameters
+
+    message = Message()
+    message[header] = value
+    return message.get_param(param, header=header)
+
+
+class _Part:
+    def __init__(self, raw_headers, spool_threshold):
+        headers = {}
+        for line in raw_headers.decode("utf-8").split("\r\n"):
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+
+        disposition = headers.get("content-disposition", "")
+        self.name = _header_param("Content-Disposition", disposition, "name")
+        filename = _header_param("Content-Disposition", disposition, "filename")
+        if filename is None:
+            self.upload = None
+            self.data = bytearray()
+        else:
+            file = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+            self.upload = UploadedFile(self.name, filename, headers.get("content-type", "application/octet-stream"), file)
+
+    def write(self, data):
+        if self.upload is None:
+            self.data += data
+        else:
+            self.upload.file.write(data)
+            self.upload.size += len(data)
+
+
+def parse_multipart(chunks, boundary, spool_threshold=SPOOL_THRESHOLD):
+    delimiter = b"--" + boundary
+    separator = b"\r\n" + delimiter
+    fields = MultiDict()
+    files = MultiDict()
+
+    buffer = b""
+    state = "preamble"
+    part = None
+
+    for chunk in chunks:
+        buffer += chunk
+        while True:
+            if state == "preamble":
+                index = buffer.find(delimiter)
+                if index == -1:
+                    break
+                buffer = buffer[index + len(delimiter):]
+                state = "boundary"
+
+            elif state == "boundary":  # right after a delimiter: "--" ends the body, CRLF starts a part
+                if len(buffer) < 2:
+                    break
+                if buffer.startswith(b"--"):
+                    return fields, files
+                buffer = buffer[2:]
+                state = "headers"
+
+            elif state == "headers":
+                index = buffer.find(b"\r\n\r\n")
+                if index == -1:
+                    break
+                part = _Part(buffer[:index], spool_threshold)
+                buffer = buffer[index + 4:]
+                state = "body"
+
+            else:
+                index = buffer.find(separator)
+                if index == -1:
+                    # keep enough bytes to recognise a separator split across two chunks
+                    keep = len(separator) - 1
+                    if len(buffer) > keep:
+                        part.write(buffer[:-keep])
+                        buffer = buffer[-keep:]
+                    break
+
+                part.write(buffer[:index])
+                buffer = buffer[index + len(separator):]
+                if part.upload is None:
+                    fields.add(part.name, part.data.decode("utf-8"))
+                else:
+                    part.upload.file.seek(0)
+                    files.add(part.name, part.upload)
+                state = "boundary"
+
+    raise ValueError("The multipart/form-data body ended before the closing boundary")
@@ -1,7 +1,14 @@
 import json
-from webob import Response as WebObResponse
+import time
+from http import HTTPStatus
+from .metrics import server_timing
+
+STATUS_LINES = {status.value: f"{status.value} {status.phrase}" for status in HTTPStatus}
+DEFAULT_CONTENT_TYPE = "text/html"
 
 class Response:
+    use_webob = False  # build a webob.Response for every response like older versions did, set by API(webob_responses=True)
+
     def __init__(self):
         self.text = None
         self.json = None
@@ -9,14 +16,94 @@ class Response:
         self.status_code = 200
         self.body = b''
         self.content_type = None
+        self.stream = None  # an iterable of bytes sent as the body as it's produced, instead of body
+        self.headers = {}
+        self.cookies = []  # Set-Cookie header values
+        self.timings = []  # (name, seconds) pairs reported in the Server-Timing header
+        self.background_tasks = []
+        self.on_close = None  # called by the server once the body has been sent
+
+    # Schedules fn(*args, **kwargs) to run after the response has been sent to the client
+    def background(self, fn, *args, **kwargs):
+        self.background_tasks.append((fn, args, kwargs))
     
+    def set_cookie(self, name, value, max_age=None, path="/", domain=None, secure=False, httponly=False, samesite=None):
+        from http.cookies import SimpleCookie
+
+        cookie = SimpleCookie()
+        cookie[name] = value
+        morsel = cookie[name]
+        morsel["path"] = path
+        if max_age is not None:
+            morsel["max-age"] = max_age
+        if domain is not None:
+            morsel["domain"] = domain
+        if secure:
+            morsel["secure"] = True
+        if httponly:
+            morsel["httponly"] = True
+        if samesite is not None:
+            morsel["samesite"] = samesite
+        self.cookies.append(morsel.OutputString())
+
+    def delete_cookie(self, name, path="/", domain=None):
+        self.set_cookie(name, "", max_age=0, path=path, domain=domain)
+
     def __call__(self, environ, start_response):
+        started = time.perf_counter()
         self.set_body_and_content_type()
-        
-        response = WebObResponse(
-            body = self.body, content_type=self.content_type, status=self.status_code
-        )
-        return response(environ, start_response)
+
+        if self.use_webob:
+            app_iter = self._webob_response(started)(environ, start_response)
+        else:
+            app_iter = self._start_response(environ, start_response, started)
+
+        if self.on_close is not None:
+            return ClosingIterator(app_iter, self.on_close)
+        return app_iter
+
+    # Calls start_response directly with a status line from the table and a plain header list
+    def _start_response(self, environ, start_response, started):
+        content_type = self.content_type or DEFAULT_CONTENT_TYPE
+        if content_type.startswith("text/") and "charset=" not in content_type:
+            content_type += "; charset=UTF-8"
+        headers = [("Content-Type", content_type)]
+
+        body = self.body.encode("utf-8") if isinstance(self.body, str) else self.body
+        if self.stream is None:
+            headers.append(("Content-Length", str(len(body))))
+        overridden = {name.lower() for name in self.headers}  # headers set by the handler win
+        headers = [(name, value) for name, value in headers if name.lower() not in overridden]
+        headers.extend(self.headers.items())
+        headers.extend(("Set-Cookie", cookie) for cookie in self.cookies)
+
+        self.timings.append(("serialise", time.perf_counter() - started))
+        headers.append(("Server-Timing", server_timing(self.timings)))
+
+        status = STATUS_LINES.get(self.status_code) or f"{self.status_code} Unknown"
+        start_response(status, headers)
+
+        if environ["REQUEST_METHOD"] == "HEAD":
+            if self.stream is not None and hasattr(self.stream, "close"):
+                self.stream.close()
+            return []
+        return self.stream if self.stream is not None else [body]
+
+    def _webob_response(self, started):
+        from webob import Response as WebObResponse
+
+        if self.stream is not None:
+            response = WebObResponse(app_iter=self.stream, content_type=self.content_type, status=self.status_code)
+        else:
+            response = WebObResponse(
+                body = self.body, content_type=self.content_type, status=self.status_code
+            )
+        response.headers.update(self.headers)
+        for cookie in self.cookies:
+            response.headerlist.append(("Set-Cookie", cookie))
+        self.timings.append(("serialise", time.perf_counter() - started))
+        response.headers["Server-Timing"] = server_timing(self.timings)
+        return response
     
     def set_body_and_content_type(self):
         if self.json is not None:
@@ -30,4 +117,20 @@ class Response:
         if self.html is not None:
             self.body = self.html.encode()
             self.content_type = "text/html"
-    
\ No newline at end of file
+    
+
+# WSGI servers call close() on the returned iterable after the last byte has been written
+class ClosingIterator:
+    def __init__(self, app_iter, on_close):
+        self.app_iter = app_iter
+        self.on_close = on_close
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, "close"):
+                self.app_iter.close()
+        finally:
+            self.on_close()
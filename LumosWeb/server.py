@@ -0,0 +1,97 @@
+import os
+import socket
+import threading
+import time
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+# Environment variable holding the listening socket handed down to a re-executed server
+LISTEN_FD_ENV = "LUMOS_LISTEN_FD"
+SYSTEMD_FIRST_FD = 3
+
+
+class LumosServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    block_on_close = False  # server_close() doesn't wait, drain() does that with a deadline
+    request_queue_size = socket.SOMAXCONN  # connections wait here while a SIGHUP restart drains and re-imports the app
+
+    def __init__(self, *args, **kwargs):
+        self.in_flight = 0
+        self._idle = threading.Condition()
+        super().__init__(*args, **kwargs)
+
+    # Counted in the accepting thread, so drain() also waits for connections whose thread hasn't started yet
+    def process_request(self, request, client_address):
+        with self._idle:
+            self.in_flight += 1
+        try:
+            super().process_request(request, client_address)
+        except BaseException:
+            self._done()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._done()
+
+    def _done(self):
+        with self._idle:
+            self.in_flight -= 1
+            self._idle.notify_all()
+
+    # Waits up to timeout seconds for the requests being handled, returns False if some didn't finish
+    def drain(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._idle:
+            while self.in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def adopt(self, sock):
+        self.socket.close()  # the unbound one TCPServer.__init__ created
+        self.socket = sock
+        self.server_address = sock.getsockname()
+        host, port = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.server_activate()
+
+
+# A listening socket passed down by a previous server process (SIGHUP restart) or by systemd socket activation
+def inherited_socket():
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is None and os.environ.get("LISTEN_PID") == str(os.getpid()) and int(os.environ.get("LISTEN_FDS", 0)) > 0:
+        fd = SYSTEMD_FIRST_FD
+    if fd is None:
+        return None
+    return socket.socket(fileno=int(fd))
+
+
+# Binds the real server socket right away, instead of probing ports with throwaway sockets that
+# another process could grab before the server binds them again.
+def make_server(host, port, app, max_attempts=10):
+    sock = inherited_socket()
+    if sock is not None:
+        server = LumosServer((host, port), WSGIRequestHandler, bind_and_activate=False)
+        server.set_app(app)
+        server.adopt(sock)
+        return server
+
+    attempts = 0
+    while True:
+        try:
+            server = LumosServer((host, port), WSGIRequestHandler)
+            server.set_app(app)
+            return server
+        except OSError:
+            print(f"Port {port} is not available, trying the next port")
+            attempts += 1
+            port += 1
+            if attempts > max_attempts:
+                raise Exception("No ports available to run the API")
@@ -0,0 +1,136 @@
+import json
+import threading
+from collections import deque
+
+HEARTBEAT = b": heartbeat\n\n"
+
+
+def format_event(data, event=None, id=None):
+    if not isinstance(data, str):
+        data = json.dumps(data)
+
+    lines = []
+    if event is not None:
+        lines.append(f"event: {event}")
+    if id is not None:
+        lines.append(f"id: {id}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return ("\n".join(lines) + "\n\n").encode("utf-8")
+
+
+# One connected client. Slow clients can't hold the publisher up or grow memory without bounds:
+# when the buffer is full the oldest messages are dropped.
+class Subscription:
+    def __init__(self, hub, channel, max_buffer):
+        self.hub = hub
+        self.channel = channel
+        self.buffer = deque(maxlen=max_buffer)
+        self.dropped = 0
+        self.ended = False
+        self._ready = threading.Event()
+
+    def push(self, message):
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+        self.buffer.append(message)
+        self._ready.set()
+
+    # Returns the buffered messages, waiting up to timeout seconds for the first one
+    def wait(self, timeout=None):
+        if not self.buffer and not self.ended:
+            self._ready.wait(timeout)
+        self._ready.clear()
+
+        messages = []
+        while self.buffer:
+            messages.append(self.buffer.popleft())
+        return messages
+
+    # Wakes the stream up so it finishes once the buffered messages are sent
+    def end(self):
+        self.ended = True
+        self._ready.set()
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+# In-process pub/sub for server-sent events routes. Events are encoded once per publish, no matter
+# how many clients are subscribed to the channel.
+class EventHub:
+    def __init__(self, max_buffer=100):
+        self.max_buffer = max_buffer
+        self.closed = False
+        self._channels = {}  # channel -> set of Subscriptions
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel, max_buffer=None):
+        subscription = Subscription(self, channel, max_buffer or self.max_buffer)
+        with self._lock:
+            if self.closed:
+                subscription.end()
+            else:
+                self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._channels[subscription.channel]
+
+    def publish(self, channel, data, event=None, id=None):
+        message = format_event(data, event, id)
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.push(message)
+        return len(subscriptions)
+
+    # Ends every open stream, and the ones subscribing from now on, so a shutting down server
+    # doesn't wait for clients that would otherwise stay connected forever
+    def close(self):
+        with self._lock:
+            self.closed = True
+            subscriptions = [subscription for channel in self._channels.values() for subscription in channel]
+            self._channels.clear()
+        for subscription in subscriptions:
+            subscription.end()
+
+    def subscribers(self, channel):
+        with self._lock:
+            return len(self._channels.get(channel, ()))
+
+
+# Body of an SSE response subscribed to the hub. A comment line is sent when there was nothing to
+# say for `heartbeat` seconds, so proxies don't time the connection out and dead clients are noticed.
+class EventStream:
+    def __init__(self, subscription, heartbeat=15.0):
+        self.subscription = subscription
+        self.heartbeat = heartbeat
+
+    def __iter__(self):
+        yield b": connected\n\n"
+        while True:
+            messages = self.subscription.wait(self.heartbeat)
+            if messages:
+                yield b"".join(messages)
+            elif self.subscription.ended:
+                return
+            else:
+                yield HEARTBEAT
+
+    # the server closes the body when the client has gone away
+    def close(self):
+        self.subscription.close()
+
+
+# Body of an SSE response whose handler returned its own events, as data or (data, event) pairs
+def encode(events):
+    for item in events:
+        if isinstance(item, tuple):
+            yield format_event(*item)
+        else:
+            yield format_event(item)
@@ -0,0 +1,169 @@
+import json as json_module
+import sys
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+from http.cookies import SimpleCookie
+from io import BytesIO
+from urllib.parse import unquote_to_bytes, urlencode, urlsplit
+from wsgiref.headers import Headers
+
+
+class TestResponse:
+    __test__ = False  # not a test class, despite the name
+
+    def __init__(self, status, headers, content):
+        code, _, reason = status.partition(" ")
+        self.status_code = int(code)
+        self.reason = reason
+        self.headers = Headers(headers)  # case insensitive lookups
+        self.content = content
+
+    @property
+    def text(self):
+        charset = "utf-8"
+        for param in self.headers.get("Content-Type", "").split(";")[1:]:
+            key, _, value = param.strip().partition("=")
+            if key.lower() == "charset":
+                charset = value
+        return self.content.decode(charset)
+
+    def json(self):
+        return json_module.loads(self.content)
+
+
+# Calls the WSGI app in-process with an environ built from the arguments, without any HTTP
+# library in between. Clients share no state, so tests using them can run in parallel (pytest-xdist).
+class TestClient:
+    __test__ = False
+
+    def __init__(self, app, base_url="http://testserver"):
+        self.app = app
+        self.base_url = base_url
+        self.cookies = {}
+
+    def request(self, method, url, params=None, data=None, json=None, files=None, headers=None):
+        url = urlsplit(url if "://" in url else self.base_url + url)
+        query = url.query
+        if params:
+            query = "&".join(filter(None, [query, urlencode(params, doseq=True)]))
+
+        body, content_type = _encode_body(data, json, files)
+        environ = {
+            "REQUEST_METHOD": method.upper(),
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(url.path).decode("latin-1") or "/",  # bytes as latin-1, like PEP 3333 wants
+            "QUERY_STRING": query,
+            "SERVER_NAME": url.hostname or "testserver",
+            "SERVER_PORT": str(url.port or (443 if url.scheme == "https" else 80)),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "HTTP_HOST": url.netloc,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": url.scheme,
+            "wsgi.input": BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": False,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if body:
+            environ["CONTENT_LENGTH"] = str(len(body))
+        if content_type is not None:
+            environ["CONTENT_TYPE"] = content_type
+        if self.cookies:
+            environ["HTTP_COOKIE"] = "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+        for name, value in (headers or {}).items():
+            key = name.upper().replace("-", "_")
+            if key in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                environ[key] = value
+            else:
+                environ["HTTP_" + key] = value
+
+        started = []
+
+        def start_response(status, response_headers, exc_info=None):
+            started[:] = [status, response_headers]
+
+        result = self.app(environ, start_response)
+        try:
+            content = b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+        response = TestResponse(started[0], started[1], content)
+        for header in response.headers.get_all("Set-Cookie"):
+            for name, morsel in SimpleCookie(header).items():
+                if _expired(morsel):
+                    self.cookies.pop(name, None)
+                else:
+                    self.cookies[name] = morsel.value
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request("PATCH", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def options(self, url, **kwargs):
+        return self.request("OPTIONS", url, **kwargs)
+
+
+# Cookies deleted by the server, with Max-Age=0 or an Expires date in the past
+def _expired(morsel):
+    if morsel["max-age"]:
+        try:
+            return int(morsel["max-age"]) <= 0
+        except ValueError:
+            pass
+    if morsel["expires"]:
+        try:
+            return parsedate_to_datetime(morsel["expires"]).timestamp() <= time.time()
+        except (TypeError, ValueError):
+            pass
+    return False
+
+
+def _encode_body(data, json, files):
+    if json is not None:
+        return json_module.dumps(json).encode("utf-8"), "application/json"
+    if files:
+        return _encode_multipart(data or {}, files)
+    if isinstance(data, dict):
+        return urlencode(data, doseq=True).encode("utf-8"), "application/x-www-form-urlencoded"
+    if isinstance(data, str):
+        return data.encode("utf-8"), None
+    return data or b"", None
+
+
+# files maps field names to (filename, content) or (filename, content, content_type), like requests does
+def _encode_multipart(data, files):
+    boundary = uuid.uuid4().hex
+    lines = []
+    for name, value in data.items():
+        lines.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n'.encode())
+        lines.append(str(value).encode("utf-8") + b"\r\n")
+    for name, (filename, content, *content_type) in files.items():
+        content_type = content_type[0] if content_type else "application/octet-stream"
+        lines.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n".encode()
+        )
+        if hasattr(content, "read"):
+            content = content.read()
+        lines.append((content.encode("utf-8") if isinstance(content, str) else content) + b"\r\n")
+    lines.append(f"--{boundary}--\r\n".encode())
+    return b"".join(lines), f"multipart/form-data; boundary={boundary}"
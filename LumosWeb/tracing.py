@@ -0,0 +1,62 @@
+import contextvars
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+
+logger = logging.getLogger("LumosWeb.orm")
+
+Query = namedtuple("Query", ["sql", "params", "duration", "rows"])
+
+# The trace of the request (or assert_num_queries block) currently running in this thread/task.
+_current_trace = contextvars.ContextVar("lumos_query_trace", default=None)
+
+
+class QueryTrace:
+    def __init__(self, repeat_threshold=5, parent=None):
+        self.queries = []
+        self.repeat_threshold = repeat_threshold  # same statement this many times looks like an N+1
+        self.parent = parent
+        self._counts = {}
+
+    def record(self, sql, params, duration, rows):
+        self.queries.append(Query(sql, params, duration, rows))
+
+        # the ORM always binds values as parameters, so the same statement text means the same query shape
+        count = self._counts[sql] = self._counts.get(sql, 0) + 1
+        if count == self.repeat_threshold and self.parent is None:  # the outermost trace does the warning
+            logger.warning("Possible N+1 queries: %r executed %d times in one request", sql, count)
+
+        if self.parent is not None:
+            self.parent.record(sql, params, duration, rows)
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(query.duration for query in self.queries)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def trace_queries(repeat_threshold=5):
+    trace = QueryTrace(repeat_threshold, parent=_current_trace.get())
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+# Test helper, e.g. `with assert_num_queries(2): client.get("/books")`
+@contextmanager
+def assert_num_queries(n):
+    with trace_queries() as trace:
+        yield trace
+
+    executed = "\n".join(query.sql for query in trace.queries)
+    assert trace.count == n, f"Expected {n} queries, {trace.count} were executed:\n{executed}"
@@ -1,5 +1,4 @@
 import pytest
-import os
 
 from LumosWeb.api import API
 from LumosWeb.orm import Database, Table, Column, ForeignKey
@@ -11,13 +10,11 @@ def api():
 
 @pytest.fixture
 def client(api):
-    return api.test_session()
+    return api.test_client()
 
 @pytest.fixture
-def db():
-    DB_PATH = "./test.db"
-    if os.path.exists(DB_PATH):
-        os.remove(DB_PATH)
+def db(tmp_path):
+    DB_PATH = str(tmp_path / "test.db")  # one file per test, so tests can run in parallel with pytest-xdist
     db = Database(DB_PATH)
     return db
 
@@ -1,12 +1,28 @@
+import os
+import signal
 import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.request import urlopen
+from wsgiref.util import setup_testing_defaults
+
 import pytest
 
 from LumosWeb.api import API
 from LumosWeb.middleware import Middleware
+from LumosWeb.cache import CachedResponse, MemoryBackend, SQLiteBackend
+from LumosWeb.admission import ConcurrencyLimit
+from LumosWeb.exceptions import ServiceUnavailable
+from LumosWeb.background import BackgroundPool
+from LumosWeb.sse import EventHub, EventStream
+from LumosWeb.profiling import Profiler
 
 FILE_DIR ="css"
 FILE_NAME = "main.css"
 FILE_CONTENTS = "body {background-color: #d0e4fe}"
+IMPORT_TIME_BUDGET_US = 250_000
 
 
 # helpers
@@ -260,3 +276,763 @@ def test_run_exception_other_error(api):
     finally:
         assert not api.is_running()
 
+
+def test_metrics_are_recorded_per_route_template(api, client):
+    @api.route("/hello/{name}", allowed_methods=["get"])
+    def hello(req, resp, name):
+        resp.text = f"Hey {name}"
+
+    api.add_metrics_route()
+
+    client.get("http://testserver/hello/sdd")
+    client.get("http://testserver/hello/lumos")
+    client.get("http://testserver/doesnotexist")
+
+    metrics = client.get("http://testserver/metrics").text
+    assert 'lumos_requests_total{method="GET",route="/hello/{name}",status="200"} 2' in metrics
+    assert 'lumos_requests_total{method="GET",route="<unmatched>",status="404"} 1' in metrics
+    assert 'lumos_request_duration_seconds_count{route="/hello/{name}"} 2' in metrics
+
+def test_server_timing_header(api, client):
+    @api.route("/timed", allowed_methods=["get"])
+    def timed(req, resp):
+        resp.text = "Timed"
+
+    header = client.get("http://testserver/timed").headers["Server-Timing"]
+    assert [part.split(";")[0] for part in header.split(", ")] == ["routing", "handler", "serialise"]
+
+def test_metrics_are_aggregated_across_workers(tmpdir):
+    worker_1 = API(metrics_dir=str(tmpdir))
+    worker_2 = API(metrics_dir=str(tmpdir))
+    for worker, hits, shed in ((worker_1, 3, 1), (worker_2, 4, 2)):
+        worker.limit_concurrency(1)
+        worker.concurrency_limit.shed_total = shed
+        worker.response_cache.hits = hits
+    worker_1.metrics.observe("GET", "/", 200, 0.01)
+    worker_1.metrics.flush()
+
+    # both instances live in the same process here, so fake a second pid for worker_1's file
+    tmpdir.join(f"metrics_{os.getpid()}.json").rename(tmpdir.join("metrics_1.json"))
+    worker_2.metrics.observe("GET", "/", 200, 0.02)
+
+    metrics = worker_2.metrics.render()
+    assert 'lumos_requests_total{method="GET",route="/",status="200"} 2' in metrics
+    assert "lumos_cache_hits_total 7" in metrics
+    assert 'lumos_admission_shed_total{scope="global"} 3' in metrics
+
+def test_profiling_with_authorised_header(api, client, tmpdir):
+    api.enable_profiling(str(tmpdir), token="secret")
+
+    @api.route("/slow/{id:d}", allowed_methods=["get"])
+    def slow(req, resp, id):
+        resp.text = str(sum(range(1000)))
+
+    client.get("http://testserver/slow/1")
+    client.get("http://testserver/slow/1", headers={"X-Lumos-Profile": "wrong"})
+    assert client.get("http://testserver/slow/1", headers={"X-Lumos-Profile": "café"}).status_code == 200
+    assert tmpdir.listdir() == []
+
+    assert client.get("http://testserver/slow/1", headers={"X-Lumos-Profile": "secret"}).text == "499500"
+    [profile] = tmpdir.listdir()
+    assert profile.basename.startswith("slow_id_d-") and profile.ext == ".prof"
+
+def test_concurrent_requests_are_profiled_one_at_a_time(tmpdir):
+    profiler = Profiler(str(tmpdir))
+    entered, release = threading.Event(), threading.Event()
+
+    def slow():
+        entered.set()
+        release.wait(5)
+
+    thread = threading.Thread(target=profiler.run, args=("/slow", slow))
+    thread.start()
+    entered.wait(5)
+
+    assert profiler.run("/fast", lambda: "fast") == "fast"  # runs without profiling
+    release.set()
+    thread.join()
+    [profile] = tmpdir.listdir()
+    assert profile.basename.startswith("slow-")
+
+def test_profiling_collapsed_stacks_for_configured_routes(api, client, tmpdir):
+    api.enable_profiling(str(tmpdir), routes=["/work"], format="collapsed")
+
+    def work():
+        return sorted(range(1000), reverse=True)
+
+    @api.route("/work", allowed_methods=["get"])
+    def handler(req, resp):
+        resp.text = str(len(work()))
+
+    client.get("http://testserver/work")
+    [profile] = tmpdir.listdir()
+    lines = profile.read().splitlines()
+    assert any("handler (test_lumos.py" in line and "work (test_lumos.py" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+
+def test_request_queries_are_recorded(api, client, db, Author):
+    db.create(Author)
+    api.add_metrics_route()
+
+    @api.route("/authors", allowed_methods=["get"])
+    def authors(req, resp):
+        resp.json = [author.name for author in db.all(Author)]
+
+    response = client.get("http://testserver/authors")
+    assert "db;dur=" in response.headers["Server-Timing"]
+    assert 'lumos_db_queries_total{route="/authors"} 1' in client.get("http://testserver/metrics").text
+
+def test_import_time_budget():
+    # -X importtime writes "import time: self [us] | cumulative | module" lines to stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import LumosWeb.api, LumosWeb.cli"],
+        capture_output=True, text=True, check=True,
+    )
+    cumulative = {}
+    for line in result.stderr.splitlines()[1:]:
+        _, time_us, module = line.split("|")
+        cumulative[module.strip()] = int(time_us)
+
+    lazy_modules = {"requests", "wsgiadapter", "jinja2", "whitenoise", "markdown", "pygments", "cProfile"}
+    assert lazy_modules.isdisjoint(cumulative)
+    assert cumulative["LumosWeb.api"] < IMPORT_TIME_BUDGET_US
+
+def test_cached_route(api, client):
+    calls = []
+
+    @api.route("/cached", allowed_methods=["get"], cache=60, vary=["Accept-Language"])
+    def cached(req, resp):
+        calls.append(req.params.get("page"))
+        resp.json = {"call": len(calls)}
+
+    assert client.get("http://testserver/cached").json() == {"call": 1}
+    response = client.get("http://testserver/cached")
+    assert response.json() == {"call": 1}
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.headers["Vary"] == "Accept-Language"
+
+    assert client.get("http://testserver/cached?page=2").json() == {"call": 2}
+    assert client.get("http://testserver/cached", headers={"Accept-Language": "tr"}).json() == {"call": 3}
+
+def test_personalised_responses_are_not_cached(api, client):
+    calls = []
+
+    @api.route("/page", allowed_methods=["get"], cache=60)
+    def page(req, resp):
+        calls.append(req.headers.get("Authorization"))
+        resp.text = f"call {len(calls)}"
+
+    @api.route("/login", allowed_methods=["get"], cache=60)
+    def login(req, resp):
+        calls.append("login")
+        resp.set_cookie("session", "abc")
+
+    @api.route("/private", allowed_methods=["get"], cache=60)
+    def private(req, resp):
+        calls.append("private")
+        resp.headers["Cache-Control"] = "private"
+
+    assert client.get("/page", headers={"Authorization": "Bearer alice"}).text == "call 1"
+    assert client.get("/page").text == "call 2"
+    assert client.get("/page", headers={"Authorization": "Bearer bob"}).text == "call 3"
+    assert client.get("/page").text == "call 2"
+
+    client.get("/private")
+    client.get("/private")
+    client.get("/login")
+    client.cookies.clear()
+    client.get("/login")
+    assert calls.count("private") == 2 and calls.count("login") == 2
+
+def test_concurrent_cache_misses_are_collapsed(api):
+    calls = []
+    started = threading.Event()
+
+    def compute():
+        calls.append(1)
+        started.set()
+        time.sleep(0.1)
+        return CachedResponse(200, "text/plain", {}, b"slow")
+
+    def request():
+        results.append(api.response_cache.fetch("key", 60, compute))
+
+    results = []
+    threads = [threading.Thread(target=request) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert [entry.body for entry in results] == [b"slow"] * 5
+
+def test_cache_lru_eviction():
+    backend = MemoryBackend(max_entries=2)
+    entry = CachedResponse(200, "text/plain", {}, b"")
+    backend.set("a", entry, 60)
+    backend.set("b", entry, 60)
+    backend.get("a")
+    backend.set("c", entry, 60)
+
+    assert backend.get("a") is entry
+    assert backend.get("b") is None
+    assert backend.get("c") is entry
+
+def test_sqlite_cache_is_shared(tmpdir):
+    path = str(tmpdir.join("cache.db"))
+    entry = CachedResponse(200, "text/html", {"X-Page": "1"}, b"<h1>Lumos</h1>")
+    SQLiteBackend(path).set("key", entry, 60)
+
+    assert SQLiteBackend(path).get("key") == entry
+
+    reader = SQLiteBackend(path)
+    changes = reader.conn.total_changes
+    assert reader.get("key") == entry
+    assert reader.conn.total_changes == changes  # a fresh hit doesn't write
+
+    reader.touch_interval = 0
+    reader.get("key")
+    assert reader.conn.total_changes == changes + 1
+
+def test_overloaded_route_is_shed(api, client):
+    entered = threading.Event()
+    release = threading.Event()
+
+    @api.route("/busy", allowed_methods=["get"])
+    def busy(req, resp):
+        entered.set()
+        release.wait(5)
+        resp.text = "Done"
+
+    api.limit_concurrency(1, max_queue=0, retry_after=3, route="/busy")
+    api.add_metrics_route()
+
+    responses = []
+    thread = threading.Thread(target=lambda: responses.append(client.get("http://testserver/busy")))
+    thread.start()
+    entered.wait(5)
+
+    shed = client.get("http://testserver/busy")
+    release.set()
+    thread.join()
+
+    assert responses[0].text == "Done"
+    assert shed.status_code == 503
+    assert shed.headers["Retry-After"] == "3"
+    assert 'lumos_admission_shed_total{scope="/busy"} 1' in client.get("http://testserver/metrics").text
+
+def test_queued_request_waits_for_a_free_slot():
+    limit = ConcurrencyLimit(1, max_queue=1, queue_timeout=5)
+    limit.acquire()
+    threading.Timer(0.05, limit.release).start()
+
+    limit.acquire()  # blocks until the timer frees the slot
+    assert limit.queued_total == 1
+
+    with pytest.raises(ServiceUnavailable):
+        limit.queue_timeout = 0.01
+        limit.acquire()
+    assert limit.shed_total == 1
+
+def test_service_unavailable_goes_through_exception_handler(api, client):
+    def on_exception(req, resp, exc):
+        resp.text = f"Custom: {exc}"
+
+    api.add_exception_handler(on_exception)
+    api.limit_concurrency(1)
+    api.concurrency_limit.acquire()  # simulate a request that is already being handled
+
+    @api.route("/", allowed_methods=["get"])
+    def index(req, resp):
+        resp.text = "Hello"
+
+    response = client.get("http://testserver/")
+    assert response.status_code == 503
+    assert response.text == "Custom: Service unavailable, please retry later."
+
+def test_service_unavailable_with_json_exception_handler(api, client):
+    def on_exception(req, resp, exc):
+        resp.json = {"error": str(exc)}
+
+    api.add_exception_handler(on_exception)
+    api.limit_concurrency(1)
+    api.concurrency_limit.acquire()
+
+    @api.route("/", allowed_methods=["get"])
+    def index(req, resp):
+        resp.text = "Hello"
+
+    response = client.get("http://testserver/")
+    assert response.status_code == 503
+    assert response.headers["Content-Type"] == "application/json"
+    assert response.json() == {"error": "Service unavailable, please retry later."}
+
+def test_queued_route_requests_dont_hold_global_slots(api, client):
+    @api.route("/", allowed_methods=["get"])
+    def index(req, resp):
+        resp.text = "Hello"
+
+    @api.route("/slow", allowed_methods=["get"])
+    def slow(req, resp):
+        resp.text = "Slow"
+
+    api.limit_concurrency(1)
+    api.limit_concurrency(1, max_queue=1, queue_timeout=5, route="/slow")
+    route_limit = api.routes["/slow"]["limit"]
+    route_limit.acquire()  # a slow request is being handled
+
+    responses = []
+    queued = threading.Thread(target=lambda: responses.append(api.test_client().get("http://testserver/slow")))
+    queued.start()
+    while route_limit.queued == 0:
+        time.sleep(0.001)
+
+    assert client.get("http://testserver/").text == "Hello"
+    route_limit.release()
+    queued.join()
+    assert responses[0].text == "Slow"
+
+def test_streaming_request_body(api, client):
+    @api.route("/upload", allowed_methods=["post"])
+    def upload(req, resp):
+        chunks = list(req.stream(chunk_size=4))
+        resp.json = {"chunks": len(chunks), "size": sum(len(chunk) for chunk in chunks)}
+
+    assert client.post("http://testserver/upload", data=b"0123456789").json() == {"chunks": 3, "size": 10}
+
+def test_body_larger_than_max_body_size_is_rejected(api, client):
+    @api.route("/upload", allowed_methods=["post"], max_body_size=8)
+    def upload(req, resp):
+        resp.text = "Uploaded"
+
+    assert client.post("http://testserver/upload", data=b"01234567").text == "Uploaded"
+
+    response = client.post("http://testserver/upload", data=b"0123456789")
+    assert response.status_code == 413
+    assert response.text == "Request body is larger than 8 bytes."
+
+    response = client.post("http://testserver/upload", data=b"0123", headers={"Content-Length": "abc"})
+    assert response.text == "Uploaded"
+
+def test_multipart_upload_is_spooled(api, client):
+    uploads = {}
+
+    @api.route("/upload", allowed_methods=["post"])
+    def upload(req, resp):
+        fields, files = req.multipart(spool_threshold=16, chunk_size=7)
+        uploads.update(files)
+        resp.json = {"title": fields["title"], "size": files["document"].size, "body": files["document"].read().decode()}
+
+    content = "x" * 100
+    response = client.post(
+        "http://testserver/upload",
+        data={"title": "Lumos"},
+        files={"document": ("notes.txt", content, "text/plain")},
+    )
+
+    assert response.json() == {"title": "Lumos", "size": 100, "body": content}
+    assert uploads["document"].filename == "notes.txt"
+    assert uploads["document"].content_type == "text/plain"
+    assert uploads["document"].file._rolled  # bigger than the spool threshold, so it went to disk
+
+def test_multipart_post_consumes_the_body(api, client):
+    @api.route("/form", allowed_methods=["post"])
+    def form(req, resp):
+        title = req.POST["title"]
+        with pytest.raises(RuntimeError):
+            req.body
+        resp.json = {"title": title, "again": req.POST["title"], "webob": req.webob.body == b""}
+
+    response = client.post("http://testserver/form", data={"title": "Lumos"}, files={"f": ("a.txt", "a")})
+    assert response.json() == {"title": "Lumos", "again": "Lumos", "webob": True}
+
+def test_background_tasks_run_after_response(api, client):
+    sent = []
+
+    def send_email(address, subject=None):
+        sent.append((address, subject))
+
+    @api.route("/signup", allowed_methods=["post"])
+    def signup(req, resp):
+        resp.background(send_email, "lumos@example.com", subject="Welcome")
+        resp.text = "Signed up"
+
+    assert client.post("http://testserver/signup").text == "Signed up"
+    assert api.shutdown(timeout=5)
+    assert sent == [("lumos@example.com", "Welcome")]
+
+def test_background_task_errors_go_to_exception_handler(api, client):
+    errors = []
+
+    def on_exception(req, resp, exc):
+        errors.append(exc)
+
+    def broken():
+        raise ValueError("Broken task")
+
+    api.add_exception_handler(on_exception)
+
+    @api.route("/", allowed_methods=["get"])
+    def index(req, resp):
+        resp.background(broken)
+        resp.text = "Hello"
+
+    assert client.get("http://testserver/").text == "Hello"
+    assert api.shutdown(timeout=5)
+    assert [str(error) for error in errors] == ["Broken task"]
+
+def test_background_pool_drain_timeout():
+    pool = BackgroundPool(max_workers=1, max_pending=0)
+    release = threading.Event()
+    pool.submit(release.wait, (5,))
+
+    assert pool.shutdown(timeout=0.05) is False
+    release.set()
+    assert pool.shutdown(timeout=5) is True
+    assert pool.submit(print) is False
+
+def test_background_tasks_after_shutdown_are_dropped(api, client, caplog):
+    def failing_handler(req, resp, exc):
+        raise RuntimeError("Handler broken too")
+
+    def broken():
+        raise ValueError("Broken task")
+
+    @api.route("/", allowed_methods=["get"])
+    def index(req, resp):
+        resp.background(broken)
+        resp.text = "Hello"
+
+    api.add_exception_handler(failing_handler)
+    assert client.get("http://testserver/").text == "Hello"
+    assert api.shutdown(timeout=5)
+    assert "Error handler of background task" in caplog.text
+
+    assert client.get("http://testserver/").text == "Hello"  # close() doesn't raise
+    assert "dropping task" in caplog.text
+
+def test_requests_test_session_still_works(api):
+    @api.route("/lumos", allowed_methods=["post"])
+    def lumos(req, resp):
+        resp.json = req.json
+
+    session = api.test_session()
+    assert session.post("http://testserver/lumos", json={"name": "Lumos"}).json() == {"name": "Lumos"}
+
+def test_test_client_sends_query_json_headers_and_cookies(api, client):
+    @api.route("/echo", allowed_methods=["post"])
+    def echo(req, resp):
+        resp.headers["Set-Cookie"] = "session=abc"
+        resp.json = {"page": req.params["page"], "body": req.json, "header": req.headers["X-Lumos"], "cookie": req.cookies.get("session")}
+
+    response = client.post("/echo", params={"page": 2}, json={"name": "Lumos"}, headers={"X-Lumos": "on"})
+    assert response.json() == {"page": "2", "body": {"name": "Lumos"}, "header": "on", "cookie": None}
+    assert response.headers["content-type"] == "application/json"
+    assert client.post("/echo?page=3", json={}, headers={"X-Lumos": "on"}).json()["cookie"] == "abc"
+
+def test_static_routes_are_prerendered(tmpdir_factory):
+    static_dir = tmpdir_factory.mktemp("static")
+    _create_static(static_dir)
+    build_dir = str(tmpdir_factory.mktemp("build"))
+
+    api = API(static_dir=str(static_dir))
+    api.add_static_template("/docs/intro", "index.md")
+
+    @api.route("/", allowed_methods=["get"], static=True)
+    def home(req, resp):
+        resp.html = f'<link href="/static/{FILE_DIR}/{FILE_NAME}" rel="stylesheet"><h1>Home</h1>'
+
+    assert api.build(build_dir) == {"/docs/intro": "docs/intro.html", "/": "index.html"}
+    with open(os.path.join(build_dir, "index.html")) as page:
+        assert page.read() == f"<style>{FILE_CONTENTS}</style><h1>Home</h1>"
+
+    served = API(static_dir=str(static_dir), build_dir=build_dir)
+    calls = []
+
+    @served.route("/", allowed_methods=["get"], static=True)
+    def served_home(req, resp):
+        calls.append(req)
+
+    client = served.test_client()
+    response = client.get("/")
+    assert response.text == f"<style>{FILE_CONTENTS}</style><h1>Home</h1>"
+    assert "text/html" in response.headers["Content-Type"]
+    assert "<style>" in client.get("/docs/intro").text
+    assert calls == []
+
+    # rebuilding with the build_dir in use renders the handlers again, not the previous pages
+    @served.route("/about", allowed_methods=["get"], static=True)
+    def about(req, resp):
+        resp.html = "<h1>About v2</h1>"
+
+    served.build(build_dir)
+    assert client.get("/about").text == "<h1>About v2</h1>"
+    with open(os.path.join(build_dir, "index.html")) as page:
+        assert page.read() == ""
+    assert len(calls) == 1
+
+def test_sse_route_with_own_events(api, client):
+    @api.sse("/countdown/{start:d}")
+    def countdown(req, start):
+        return [({"left": left}, "tick") for left in range(start, 0, -1)] + ["done"]
+
+    response = client.get("/countdown/2")
+    assert "text/event-stream" in response.headers["Content-Type"]
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.text == (
+        'event: tick\ndata: {"left": 2}\n\n'
+        'event: tick\ndata: {"left": 1}\n\n'
+        "data: done\n\n"
+    )
+
+def test_sse_route_subscribed_to_hub(api):
+    @api.sse("/events", heartbeat=0.01)
+    def events(req):
+        return "dashboard"
+
+    environ = {"PATH_INFO": "/events", "REQUEST_METHOD": "GET"}
+    setup_testing_defaults(environ)
+    body = api(environ, lambda status, headers: None)
+    chunks = iter(body)
+
+    assert next(chunks) == b": connected\n\n"
+    assert api.events.subscribers("dashboard") == 1
+    assert next(chunks) == b": heartbeat\n\n"
+
+    assert api.events.publish("dashboard", {"users": 3}, id=1) == 1
+    assert next(chunks) == b'id: 1\ndata: {"users": 3}\n\n'
+
+    body.close()  # what the server does when the client disconnects
+    assert api.events.subscribers("dashboard") == 0
+
+def test_closing_the_hub_ends_the_streams():
+    hub = EventHub()
+    stream = iter(EventStream(hub.subscribe("prices"), heartbeat=10))
+    assert next(stream) == b": connected\n\n"
+
+    hub.publish("prices", "1")
+    hub.close()
+    assert list(stream) == [b"data: 1\n\n"]
+    assert list(EventStream(hub.subscribe("prices"), heartbeat=10)) == [b": connected\n\n"]
+
+def test_sse_handler_return_types(api, client):
+    hub = EventHub()
+
+    @api.sse("/other")
+    def other(req):
+        return hub.subscribe("news")
+
+    @api.sse("/wrong")
+    def wrong(req):
+        return hub
+
+    environ = {"PATH_INFO": "/other", "REQUEST_METHOD": "GET"}
+    setup_testing_defaults(environ)
+    body = api(environ, lambda status, headers: None)
+    chunks = iter(body)
+    assert next(chunks) == b": connected\n\n"
+    hub.publish("news", "hello")
+    assert next(chunks) == b"data: hello\n\n"
+    body.close()
+    assert hub.subscribers("news") == 0
+
+    with pytest.raises(TypeError):
+        client.get("/wrong")
+
+def test_slow_sse_subscribers_drop_oldest_events():
+    hub = EventHub(max_buffer=2)
+    subscription = hub.subscribe("prices")
+    for price in range(3):
+        hub.publish("prices", str(price))
+
+    assert subscription.wait(0) == [b"data: 1\n\n", b"data: 2\n\n"]
+    assert subscription.dropped == 1
+
+def _wait_until_running(api):
+    for _ in range(500):
+        if api.is_running():
+            return
+        time.sleep(0.01)
+    raise AssertionError("The server didn't start")
+
+def test_run_reports_the_port_it_bound(api):
+    api.run(host="localhost", port=0, timeout=0.01)
+    try:
+        assert api.server_address[1] != 0
+        assert api._server.request_queue_size == socket.SOMAXCONN
+    finally:
+        api.shutdown(timeout=1)
+    assert not api.is_running()
+
+def test_shutdown_drains_in_flight_requests(api):
+    entered = threading.Event()
+
+    @api.route("/slow", allowed_methods=["get"])
+    def slow(req, resp):
+        entered.set()
+        time.sleep(0.2)
+        resp.text = "Finished"
+
+    server_thread = threading.Thread(target=api.run, kwargs={"host": "localhost", "port": 0})
+    server_thread.start()
+    _wait_until_running(api)
+    host, port = api.server_address
+
+    responses = []
+    request_thread = threading.Thread(target=lambda: responses.append(urlopen(f"http://{host}:{port}/slow").read()))
+    request_thread.start()
+    entered.wait(5)
+
+    assert api.shutdown(timeout=5) is True
+    request_thread.join()
+    server_thread.join(5)
+
+    assert responses == [b"Finished"]
+    assert api.state == "stopped"
+    with pytest.raises(OSError):
+        socket.create_connection((host, port), timeout=1)
+
+def test_shutdown_ends_open_sse_streams(api):
+    @api.sse("/events", heartbeat=0.05)
+    def events(req):
+        return "dashboard"
+
+    server_thread = threading.Thread(target=api.run, kwargs={"host": "localhost", "port": 0})
+    server_thread.start()
+    _wait_until_running(api)
+    host, port = api.server_address
+
+    bodies = []
+    client_thread = threading.Thread(target=lambda: bodies.append(urlopen(f"http://{host}:{port}/events").read()))
+    client_thread.start()
+    while api.events.subscribers("dashboard") == 0:
+        time.sleep(0.001)
+
+    started = time.monotonic()
+    assert api.shutdown(timeout=2) is True
+    assert time.monotonic() - started < 1
+    client_thread.join(5)
+    server_thread.join(5)
+
+    assert bodies[0].startswith(b": connected\n\n")
+    assert api.events.subscribers("dashboard") == 0
+
+def test_sigterm_stops_the_server(api):
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def send_sigterm():
+        _wait_until_running(api)
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    threading.Thread(target=send_sigterm).start()
+    api.run(host="localhost", port=0)  # returns once SIGTERM has drained the server
+
+    assert api.state == "stopped"
+    assert signal.getsignal(signal.SIGTERM) is previous_handler
+
+def test_run_adopts_inherited_socket(api, monkeypatch):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("localhost", 0))
+    listener.listen()
+    monkeypatch.setenv("LUMOS_LISTEN_FD", str(listener.fileno()))
+
+    api.run(host="localhost", port=8080, timeout=0.01)
+    try:
+        assert api.server_address == listener.getsockname()
+    finally:
+        api.shutdown(timeout=1)
+
+def test_request_is_parsed_lazily(api, client):
+    seen = {}
+
+    @api.route("/inspect/{name}", allowed_methods=["post"])
+    def inspect_request(req, resp, name):
+        seen["parsed_before"] = set(vars(req)) - {"environ"}
+        resp.json = {
+            "path": req.path,
+            "url": req.url,
+            "page": req.params["page"],
+            "title": req.params["title"],
+            "agent": req.headers["User-Agent"],
+            "cookie": req.cookies["session"],
+            "accept": str(req.accept),  # not implemented natively, comes from webob
+        }
+
+    response = client.post(
+        "http://testserver/inspect/a b?page=2",
+        data={"title": "Lumos"},
+        headers={"User-Agent": "pytest", "Cookie": "session=abc", "Accept": "text/html"},
+    )
+
+    assert seen["parsed_before"] == {"path"}  # routing needs the path, nothing else was parsed
+    assert response.json() == {
+        "path": "/inspect/a%20b",
+        "url": "http://testserver/inspect/a%20b?page=2",
+        "page": "2",
+        "title": "Lumos",
+        "agent": "pytest",
+        "cookie": "abc",
+        "accept": "text/html",
+    }
+
+def test_request_body_can_be_read_twice(api, client):
+    @api.route("/echo", allowed_methods=["post"])
+    def echo(req, resp):
+        resp.json = {"json": req.json, "chunks": b"".join(req.stream()).decode()}
+
+    assert client.post("/echo", json={"name": "Lumos"}).json() == {"json": {"name": "Lumos"}, "chunks": '{"name": "Lumos"}'}
+
+def test_response_cookies_and_status_line(api, client):
+    @api.route("/login", allowed_methods=["post"])
+    def login(req, resp):
+        resp.status_code = 201
+        resp.set_cookie("session", "abc", max_age=60, httponly=True)
+        resp.delete_cookie("old")
+        resp.text = "Welcome"
+
+    response = client.post("/login")
+    assert response.status_code == 201
+    assert response.reason == "Created"
+    assert response.headers.get_all("Set-Cookie") == [
+        "session=abc; HttpOnly; Max-Age=60; Path=/",
+        'old=""; Max-Age=0; Path=/',
+    ]
+    assert response.headers["Content-Length"] == "7"
+    assert client.cookies == {"session": "abc"}
+
+    client.cookies["old"] = "stale"
+    client.post("/login")
+    assert client.cookies == {"session": "abc"}
+
+def test_client_passes_the_path_as_latin_1(api, client):
+    @api.route("/p/{name}", allowed_methods=["get"])
+    def page(req, resp, name):
+        resp.json = {"path": req.path, "name": name}
+
+    assert client.get("/p/caf%C3%A9").json()["path"] == "/p/caf%C3%A9"
+    assert client.get("/p/日本").json()["path"] == "/p/%E6%97%A5%E6%9C%AC"
+
+@pytest.mark.parametrize("method", ["GET", "HEAD"])
+def test_webob_responses_are_opt_in_and_equivalent(method):
+    def _headers(response):
+        # a list, so duplicated headers show up
+        return sorted((name.lower(), value) for name, value in response.headers.items() if name != "Server-Timing")
+
+    responses = []
+    for webob_responses in (False, True):
+        api = API(webob_responses=webob_responses)
+
+        @api.route("/page", allowed_methods=["get", "head"])
+        def page(req, resp):
+            resp.status_code = 202
+            resp.html = "<h1>Lumos</h1>"
+            resp.headers["X-Lumos"] = "on"
+            resp.headers["Content-Type"] = "application/xml"
+            resp.set_cookie("theme", "dark")
+
+        responses.append(api.test_client().request(method, "/page"))
+
+    native, webob = responses
+    assert (native.status_code, native.content) == (webob.status_code, webob.content)
+    assert _headers(native) == _headers(webob)
@@ -1,7 +1,12 @@
+import contextvars
 import sqlite3
+import threading
 
 import pytest
 
+from LumosWeb.orm import Column, Database, DatabaseRouter, ShardedDatabase, Table, shard_by_table
+from LumosWeb.tracing import assert_num_queries, trace_queries
+
 def test_create_db(db):
     assert isinstance(db.conn, sqlite3.Connection)
     assert db.tables == []
@@ -154,4 +159,207 @@ def test_delete_author(db, Author):
 
     with pytest.raises(Exception):
         db.get(Author, 1)
-    
\ No newline at end of file
+    
+def test_queries_are_traced(db, Author, Book):
+    db.create(Author)
+    db.create(Book)
+
+    rowling = Author(name="J. K. Rowling", age=54)
+    db.save(rowling)
+    for title in ("Harry Potter", "The Casual Vacancy"):
+        db.save(Book(title=title, published=True, author=rowling))
+
+    # one query for the books, one for the author of each book
+    with assert_num_queries(3) as trace:
+        db.all(Book)
+
+    assert trace.queries[0].sql == "SELECT id, author_id, published, title FROM book;"
+    assert trace.queries[0].rows == 2
+    assert trace.queries[1].params == [1]
+
+    with pytest.raises(AssertionError):
+        with assert_num_queries(1):
+            db.all(Book)
+
+def test_repeated_queries_are_reported(db, Author, caplog):
+    db.create(Author)
+    db.save(Author(name="J. K. Rowling", age=54))
+
+    with trace_queries(repeat_threshold=3):
+        for _ in range(3):
+            db.get(Author, 1)
+
+    assert "Possible N+1 queries" in caplog.text
+
+def test_group_commit_batches_concurrent_writes(db, Author):
+    db.create(Author)
+    db.enable_group_commit(window=0.05, max_batch=100)
+
+    authors = [Author(name=f"Author {i}", age=i) for i in range(20)]
+    threads = [threading.Thread(target=db.save, args=(author,)) for author in authors]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(author.id for author in authors) == list(range(1, 21))
+    assert db.write_coordinator.commits < 20
+    assert {author.name for author in db.all(Author)} == {author.name for author in authors}
+
+    authors[0].name = "Updated"
+    assert db.update(authors[0]) == 1
+    assert db.delete(Author, authors[1].id) == 1
+    assert db.delete(Author, authors[1].id) == 0
+    assert db.get(Author, authors[0].id).name == "Updated"
+    assert len(db.all(Author)) == 19
+    db.close()
+
+    with pytest.raises(RuntimeError):
+        db.save(Author(name="Too late", age=1))
+
+def test_group_commit_failures_only_affect_their_caller(db, Author):
+    db.create(Author)
+    db.enable_group_commit(window=0.05)
+    coordinator = db.write_coordinator
+
+    errors = []
+
+    def broken_write():
+        try:
+            coordinator.execute("INSERT INTO missing (name) VALUES (?);", ["x"])
+        except sqlite3.OperationalError as e:
+            errors.append(e)
+
+    author = Author(name="J. K. Rowling", age=54)
+    threads = [threading.Thread(target=broken_write), threading.Thread(target=db.save, args=(author,))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(errors) == 1
+    assert db.get(Author, author.id).name == "J. K. Rowling"
+    db.close()
+
+def test_full_text_search(db):
+    class Article(Table):
+        title = Column(str, searchable=True)
+        body = Column(str, searchable=True)
+        views = Column(int)
+
+    db.create(Article)
+    assert "article_fts" in db.tables
+
+    wizards = Article(title="Wizards", body="Harry Potter goes to Hogwarts", views=10)
+    potions = Article(title="Potions", body="Snape teaches potions to Harry and Hermione", views=5)
+    dragons = Article(title="Dragons", body="Nothing about wizards here", views=1)
+    for article in (wizards, potions, dragons):
+        db.save(article)
+
+    assert {a.title for a in db.search(Article, "harry")} == {"Wizards", "Potions"}
+    assert [a.title for a in db.search(Article, "hermione")] == ["Potions"]
+    assert db.search(Article, "hermione")[0].views == 5
+    assert {a.title for a in db.search(Article, "wizard*", raw=True)} == {"Wizards", "Dragons"}
+    assert {a.title for a in db.search(Article, "harry OR nothing", raw=True)} == {"Wizards", "Potions", "Dragons"}
+    assert [a.title for a in db.search(Article, "harry hogwarts")] == ["Wizards"]
+    for query in ("o'brien", "spider-man", "c++", 'foo"', "OR", ""):
+        assert db.search(Article, query) == []
+    assert len(db.search(Article, "harry", limit=1)) == 1
+    assert len(db.search(Article, "harry", limit=1, offset=1)) == 1
+
+    potions.body = "Snape teaches potions"
+    db.update(potions)
+    assert [a.title for a in db.search(Article, "harry")] == ["Wizards"]
+
+    db.delete(Article, wizards.id)
+    assert db.search(Article, "harry") == []
+
+def test_search_index_on_a_table_with_rows(db):
+    class Note(Table):
+        text = Column(str)
+
+    db.create(Note)
+    note = Note(text="Remember the milk")
+    db.save(note)
+
+    class Note(Table):  # the same table, now searchable
+        text = Column(str, searchable=True)
+
+    db.create(Note)
+    assert [n.text for n in db.search(Note, "milk")] == ["Remember the milk"]
+
+    note = db.get(Note, note.id)
+    note.text = "Remember the eggs"
+    db.update(note)
+    assert db.search(Note, "milk") == []
+    assert [n.text for n in db.search(Note, "eggs")] == ["Remember the eggs"]
+
+def test_only_str_columns_are_searchable():
+    with pytest.raises(AssertionError):
+        Column(int, searchable=True)
+
+
+def test_router_reads_from_replicas_until_the_request_writes(tmp_path, Author):
+    primary = Database(str(tmp_path / "primary.db"))
+    replica = Database(str(tmp_path / "replica.db"))
+    router = DatabaseRouter(primary, [replica])
+    router.create(Author)
+
+    def write_then_read():
+        router.save(Author(name="John Doe", age=23))
+        return router.all(Author)
+
+    # the request that wrote reads its own write, other requests read the replica that hasn't caught up yet
+    assert [a.name for a in contextvars.copy_context().run(write_then_read)] == ["John Doe"]
+    assert contextvars.copy_context().run(router.all, Author) == []
+
+    primary.conn.backup(replica.conn)  # replication
+    assert contextvars.copy_context().run(router.get, Author, 1).name == "John Doe"
+
+def test_router_stickiness_lasts_one_request(api, client, tmp_path, Author):
+    primary = Database(str(tmp_path / "primary.db"))
+    replica = Database(str(tmp_path / "replica.db"))
+    router = DatabaseRouter(primary, [replica])
+    router.create(Author)
+
+    @api.route("/authors", allowed_methods=["get", "post"])
+    def authors(req, resp):
+        if req.method == "POST":
+            router.save(Author(name=req.POST["name"], age=int(req.POST["age"])))
+        resp.json = [a.name for a in router.all(Author)]
+
+    assert client.post("/authors", data={"name": "John Doe", "age": "23"}).json() == ["John Doe"]
+    assert client.get("/authors").json() == []
+
+def test_sharded_database(tmp_path, Author, Book):
+    shards = {name: Database(str(tmp_path / f"{name}.db")) for name in ("eu", "us")}
+    db = ShardedDatabase(shards, lambda table, instance: getattr(instance, "region", None))
+    db.create(Author)
+
+    john = Author(name="John Doe", age=23)
+    john.region = "eu"
+    jane = Author(name="Jane Doe", age=31)
+    jane.region = "us"
+    db.save(john)
+    db.save(jane)
+
+    assert [a.name for a in shards["eu"].all(Author)] == ["John Doe"]
+    assert db.get(Author, jane.id, shard="us").name == "Jane Doe"
+    assert {a.name for a in db.all(Author)} == {"John Doe", "Jane Doe"}
+    with pytest.raises(Exception):
+        db.get(Author, john.id)
+
+    by_table = ShardedDatabase(shards, shard_by_table({Author: "eu", Book: "us"}))
+    by_table.create(Book)
+    book = Book(title="Harry Potter", published=True, author=john)
+    by_table.save(book)
+    assert by_table.all(Book)[0].title == "Harry Potter"
+    # the author is looked up in the authors' shard, not in the books' one where id 1 is Jane
+    assert by_table.all(Book)[0].author.name == "John Doe"
+    assert by_table.get(Book, book.id).author.name == "John Doe"
+    assert "book" not in shards["eu"].tables
+
+    # a shard key that can't tell the shard from the table looks related rows up in the row's own shard
+    db.create(Book)
+    db.save(Book(title="Dune", published=True, author=jane), shard="us")
+    assert db.get(Book, 2, shard="us").author.name == "Jane Doe"